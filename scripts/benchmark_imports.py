@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+NAME: benchmark_imports.py
+DESCRIPTION: benchmark_imports.py is a python script to measure how long the scripts of this repository take to show
+             --help, and which heavy modules they load doing so. Argument parsing and validation should not wait for
+             scikit-learn, scikit-bio, matplotlib, seaborn, statsmodels or scipy, so any of them being imported by --help,
+             or a script taking much longer than a bare interpreter importing numpy and pandas (which scripts import at
+             the top), is reported as a regression. Comparing with this baseline keeps the check meaningful on slow
+             and fast machines alike.
+DATE: 22.04.2024
+"""
+
+import subprocess
+import statistics
+import time
+import os
+import sys
+import argparse
+import textwrap
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = ['mosaic_plot', 'step_curve_drawer', 'cumulative_distribution_function', 'multi_variable_pcoa_plot',
+           'evaluation_kfold', 'convert_mpa_table', 'render_batch']
+
+HEAVY_MODULES = ['sklearn', 'skbio', 'seaborn', 'statsmodels', 'scipy']
+
+BASELINE_MODULES = ['numpy', 'pandas'] # imported at the top of scripts, a floor no script can go below
+
+def read_args(args):
+    # This function is to parse arguments
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                    description = textwrap.dedent('''\
+                                     This program is to benchmark the start-up time of scripts showing --help and to list heavy modules they import.
+                                     '''),
+                                    epilog = textwrap.dedent('''\
+                                    examples: benchmark_imports.py --repeats 5 --max_ratio 1.5
+                                    '''))
+
+    parser.add_argument('--scripts',
+                        nargs = '?',
+                        help = 'Specify the scripts to benchmark, comma delimited. default: [all plotting and analysis scripts]',
+                        type = str,
+                        default = ",".join(SCRIPTS))
+
+    parser.add_argument('--repeats',
+                        nargs = '?',
+                        help = 'Specify the number of runs per script, the median time is reported. default: [3]',
+                        type = int,
+                        default = 3)
+
+    parser.add_argument('--max_ratio',
+                        nargs = '?',
+                        help = 'Specify the time budget of --help as a multiple of the time a bare interpreter takes to import numpy and pandas, \
+                                scripts exceeding it are reported as regressions. default: [1.5]',
+                        type = float,
+                        default = 1.5)
+
+    return vars(parser.parse_args())
+
+def median_seconds(command, repeats = 3):
+    # command: the arguments given to a fresh interpreter.
+    # repeats: the number of runs.
+    # this function is to return the median wall-clock time of running the command.
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, capture_output = True, check = True)
+        seconds.append(time.perf_counter() - start)
+
+    return statistics.median(seconds)
+
+def help_seconds(script, repeats = 3):
+    # script: a script name without .py.
+    # this function is to return the median wall-clock time of running the script with --help in a fresh interpreter.
+
+    return median_seconds([os.path.join(SCRIPT_DIR, script + '.py'), '--help'], repeats)
+
+def baseline_seconds(repeats = 3):
+    # this function is to return the median wall-clock time of a bare interpreter importing BASELINE_MODULES.
+
+    return median_seconds(['-c', 'import ' + ', '.join(BASELINE_MODULES)], repeats)
+
+def heavy_imports(script):
+    # script: a script name without .py.
+    # this function is to list the top-level packages among HEAVY_MODULES (and matplotlib) imported by --help,
+    # read from the interpreter's -X importtime report.
+
+    report = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(SCRIPT_DIR, script + '.py'), '--help'],
+                            capture_output = True, text = True, check = True).stderr
+    loaded = set()
+    for line in report.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        package = line.rsplit('|', 1)[1].strip().split('.')[0]
+        if package in HEAVY_MODULES + ['matplotlib']:
+            loaded.add(package)
+
+    return sorted(loaded)
+
+def benchmark(scripts, repeats = 3, max_ratio = 1.5):
+    # this function is to benchmark all scripts and return the baseline time and a list of
+    # (script, seconds, ratio to the baseline, heavy modules, passed).
+
+    baseline = baseline_seconds(repeats)
+    results = []
+    for script in scripts:
+        seconds = help_seconds(script, repeats)
+        loaded = heavy_imports(script)
+        results.append((script, seconds, seconds / baseline, loaded, seconds <= max_ratio * baseline and not loaded))
+
+    return baseline, results
+
+
+if __name__ == "__main__":
+
+    pars = read_args(sys.argv)
+    scripts = [i[:-3] if i.endswith('.py') else i for i in pars['scripts'].split(',')]
+    missing = [i for i in scripts if not os.path.isfile(os.path.join(SCRIPT_DIR, i + '.py'))]
+    if missing:
+        sys.exit("Script(s) {} are not found in {}".format(",".join(missing), SCRIPT_DIR))
+    baseline, results = benchmark(scripts, pars['repeats'], pars['max_ratio'])
+    print("Baseline (import {}): {:.3f} s".format(", ".join(BASELINE_MODULES), baseline))
+    print("\t".join(['script', 'help_seconds', 'ratio', 'heavy_imports', 'status']))
+    for script, seconds, ratio, loaded, passed in results:
+        print("\t".join([script, "{:.3f}".format(seconds), "{:.2f}".format(ratio), ",".join(loaded) or '-', 'ok' if passed else 'regression']))
+    if not all(i[4] for i in results):
+        sys.exit(1)
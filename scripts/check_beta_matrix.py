@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+NAME: check_beta_matrix.py
+DESCRIPTION: check_beta_matrix.py is a python script to check that multi_variable_pcoa_plot.py builds the same beta
+             diversity matrices as its original value-by-value builder, which is kept here as the reference. For every
+             transformation (None/sqrt/log) and metric (braycurtis/jaccard), distances and sample ids of the skbio engine
+             must be bit-identical. It also times the exact log transform against numpy's log1p, which is faster but
+             differs in the last bit, so that the price paid for identical distances stays visible and bounded.
+DATE: 30.04.2024
+"""
+
+import pandas as pd
+import numpy as np
+import math
+import time
+import os
+import sys
+import argparse
+import textwrap
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EXAMPLE_TABLE = os.path.join(SCRIPT_DIR, '..', 'example_data', 'mvpp_mpa_species_relab.tsv.bz2')
+
+TRANSFORMATIONS = [None, 'sqrt', 'log']
+
+METRICS = ['braycurtis', 'jaccard']
+
+def read_args(args):
+    # This function is to parse arguments
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                    description = textwrap.dedent('''\
+                                     This program is to check that beta diversity matrices are bit-identical to those of the original value-by-value builder.
+                                     '''),
+                                    epilog = textwrap.dedent('''\
+                                    examples: check_beta_matrix.py --max_samples 100
+                                    '''))
+
+    parser.add_argument('--abundance_table',
+                        nargs = '?',
+                        help = 'Input a merged MetaPhlAn table without wedged metadata, plain or compressed. default: [example_data/mvpp_mpa_species_relab.tsv.bz2]',
+                        type = str,
+                        default = EXAMPLE_TABLE)
+
+    parser.add_argument('--amplifier',
+                        nargs = '?',
+                        help = 'Specify the amplifier of abundance values. default: [1]',
+                        type = int,
+                        default = 1)
+
+    parser.add_argument('--max_samples',
+                        nargs = '?',
+                        help = 'Specify the number of samples (first columns) checked, the reference builder reads one value at a time \
+                                and takes a few minutes on the whole example table. default: [all samples]',
+                        type = int,
+                        default = None)
+
+    parser.add_argument('--max_log_ratio',
+                        nargs = '?',
+                        help = 'Specify how many times longer than numpy log1p the exact log transform may take. default: [10]',
+                        type = float,
+                        default = 10)
+
+    return vars(parser.parse_args())
+
+def reference_matrices(df, amplifier = 1):
+    # df: the cleaned abundance dataframe, 1st column contains clade names.
+    # this function is to build the sample x species matrix of every transformation the way multi_variable_pcoa_plot.py
+    # originally did, reading one value at a time with df.loc. Each value is read once and used for all transformations.
+
+    ids = df.columns[1:]
+    matrices = {i: [] for i in TRANSFORMATIONS}
+    for s in ids:
+        bug_abundances_one_sample = {i: [] for i in TRANSFORMATIONS}
+        for i in df.index:
+            abundance_value = df.loc[i, s]
+            bug_abundances_one_sample[None].append(float(abundance_value) * amplifier)
+            bug_abundances_one_sample['sqrt'].append(math.sqrt(float(abundance_value) * amplifier))
+            bug_abundances_one_sample['log'].append(math.log1p(float(abundance_value) * amplifier + 1))
+        for trans_func in TRANSFORMATIONS:
+            matrices[trans_func].append(bug_abundances_one_sample[trans_func])
+
+    return ids, matrices
+
+def compare_matrices(raw_df, amplifier = 1):
+    # raw_df: the merged table read into a dataframe.
+    # this function is to return a list of (transformation, metric, ids equal, distances equal, largest difference).
+
+    from skbio.diversity import beta_diversity
+    from multi_variable_pcoa_plot import BetaDiversity, clean_abundance_df
+
+    ids, matrices = reference_matrices(clean_abundance_df(raw_df), amplifier)
+    results = []
+    for trans_func in TRANSFORMATIONS:
+        for metric in METRICS:
+            expected = beta_diversity(metric, matrices[trans_func], ids)
+            observed = BetaDiversity(raw_df, None, distance_engine = 'skbio').est_beta_diversity_matrix(trans_func, metric, amplifier)
+            same_ids = tuple(observed.ids) == tuple(expected.ids)
+            same_data = observed.data.shape == expected.data.shape and np.array_equal(observed.data, expected.data)
+            difference = np.abs(observed.data - expected.data).max() if observed.data.shape == expected.data.shape else np.inf
+            results.append((trans_func, metric, same_ids, same_data, difference))
+
+    return results
+
+def log_transform_seconds(raw_df, amplifier = 1, repeats = 3):
+    # this function is to return the median time of the log transform of build_abundance_matrix and of numpy log1p
+    # on the same matrix, and the number of entries in which the two differ.
+
+    from multi_variable_pcoa_plot import BetaDiversity
+
+    beta = BetaDiversity(raw_df, None)
+    beta.load_abundance_df()
+    exact_seconds, numpy_seconds = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        exact = beta.build_abundance_matrix('log', amplifier)[1]
+        exact_seconds.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        fast = np.log1p(beta.build_abundance_matrix(None, amplifier)[1] + 1)
+        numpy_seconds.append(time.perf_counter() - start)
+
+    return np.median(exact_seconds), np.median(numpy_seconds), int(np.count_nonzero(exact != fast))
+
+
+if __name__ == "__main__":
+
+    pars = read_args(sys.argv)
+    if not os.path.isfile(pars['abundance_table']):
+        sys.exit("Please input an existing abundance table with --abundance_table!")
+    sys.path.insert(0, SCRIPT_DIR)
+    raw_df = pd.read_csv(pars['abundance_table'], sep = "\t", index_col = False)
+    if pars['max_samples']:
+        raw_df = raw_df.iloc[:, :pars['max_samples'] + 1]
+
+    results = compare_matrices(raw_df, pars['amplifier'])
+    print("\t".join(['transformation', 'metric', 'ids', 'distances', 'max_difference']))
+    for trans_func, metric, same_ids, same_data, difference in results:
+        print("\t".join([str(trans_func), metric, 'ok' if same_ids else 'differ', 'ok' if same_data else 'differ', "{:.3g}".format(difference)]))
+    exact_seconds, numpy_seconds, differing = log_transform_seconds(raw_df, pars['amplifier'])
+    ratio = exact_seconds / numpy_seconds
+    print("Log transform with the matrix build: exact {:.3f} s, numpy log1p {:.3f} s ({:.1f}x), {} entries differ in numpy".format(
+          exact_seconds, numpy_seconds, ratio, differing))
+    if not all(i[2] and i[3] for i in results) or ratio > pars['max_log_ratio']:
+        sys.exit(1)
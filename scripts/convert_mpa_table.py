@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+NAME: convert_mpa_table.py
+DESCRIPTION: This script is to convert a merged MetaPhlAn table (plain, .bz2 or .gz, optionally with metadata being
+             wedged) and an optional metadata file into a binary store, which evaluation_kfold.py, step_curve_drawer.py and
+             multi_variable_pcoa_plot.py accept in place of the table. Opening a store does not parse any text table,
+             and the abundance matrix is memory-mapped so that only the parts being used are read from disk.
+DATE: 05.04.2024
+"""
+
+import pandas as pd
+import numpy as np
+import sys
+import argparse
+import textwrap
+from mpa_reader import read_mpa_table, write_mpa_store
+
+def read_args(args):
+    # This function is to parse arguments
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                    description = textwrap.dedent('''\
+                                     This program is to convert a merged MetaPhlAn table into a binary store for fast, memory-mapped loading.
+                                     '''),
+                                    epilog = textwrap.dedent('''\
+                                    examples: convert_mpa_table.py --abundance_table <merged_table.tsv.bz2> --output <merged_table.mpastore>
+                                    '''))
+
+    parser.add_argument('--abundance_table',
+                        nargs = '?',
+                        help = 'Input the merged MetaPhlAn table, plain or compressed by bzip2/gzip, with or without metadata being wedged.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--output',
+                        nargs = '?',
+                        help = 'Specify the directory of the binary store to write, replaced if it exists.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--md_rows',
+                        nargs = '?',
+                        help = 'Input row numbers of wedged metadata, zero-based without considering header row, comma delimited. \
+                                By default, rows with non-numeric values are taken as metadata.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--clade_level',
+                        nargs = '?',
+                        help = 'Specify a MetaPhlAn rank letter, e.g. <s> or <t>, to store only clades at that level. default: [all rows]',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--dtype',
+                        nargs = '?',
+                        help = 'Specify the floating point precision of the stored matrix, <float64>/<float32>. default: [float64]',
+                        type = str,
+                        default = 'float64')
+
+    parser.add_argument('--metadata',
+                        nargs = '?',
+                        help = 'Input an optional tab-delimited metadata file whose columns are stored along with wedged metadata.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--sample_column',
+                        nargs = '?',
+                        help = 'Specify the header of column containing sample names in the metadata file.',
+                        type = str,
+                        default = None)
+
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+
+    pars = read_args(sys.argv)
+    if not pars['abundance_table'] or not pars['output']:
+        sys.exit("Please specify the input table with --abundance_table and the store with --output!")
+    if pars['dtype'] not in ['float64', 'float32']:
+        sys.exit("Please choose dtype from <float64>/<float32>")
+    if pars['metadata'] and not pars['sample_column']:
+        sys.exit("Please specify the column name containing samples in the metadata file with --sample_column!")
+
+    md_rows = [int(i) for i in pars['md_rows'].split(',')] if pars['md_rows'] else None
+    table = read_mpa_table(pars['abundance_table'], md_rows = md_rows, clade_level = pars['clade_level'], dtype = np.dtype(pars['dtype']))
+    extra_metadata = None
+    if pars['metadata']:
+        extra_metadata = pd.read_csv(pars['metadata'], sep = '\t', index_col = pars['sample_column'], dtype = str)
+    write_mpa_store(table, pars['output'], extra_metadata)
+    print("{} samples x {} features and {} metadata columns are stored in {}".format(len(table.samples), len(table.features),
+                                                                                  table.metadata.shape[1] + (extra_metadata.shape[1] if extra_metadata is not None else 0),
+                                                                                  pars['output']))
@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 
 import pandas as pd
-from scipy.stats import ranksums
-import seaborn as sns
-import matplotlib.pyplot as plt
-import matplotlib
 import sys
+import os
 import argparse
 import textwrap
 import numpy as np
+import itertools
+from permutation_tests import permuted_labels, permutation_blocks, random_stream_key
+
+# scipy and statsmodels are imported by pairwise_tests and matplotlib by VisualTools, only when they are needed.
 
 """
 NAME: cumulative_distribution_function.py
@@ -67,61 +68,208 @@ def read_args(args):
                         help = 'Specify the font size. default: [11]',
                         type = str,
                         default = 11)  
+
+    parser.add_argument('--n_cutoffs',
+                        nargs = '?',
+                        help = 'Specify the number of evenly spaced cutoffs between 0 and the maximum value. default: [10]',
+                        type = int,
+                        default = 10)
+
+    parser.add_argument('--exact',
+                        action = 'store_true',
+                        help = 'Draw the exact cumulative curve with every step, evaluating the CDF at every distinct value instead of --n_cutoffs cutoffs.')
+
+    parser.add_argument('--test_output',
+                        nargs = '?',
+                        help = 'Specify the output file name for two-sample Kolmogorov-Smirnov and Wilcoxon rank-sum tests between every pair of groups \
+                                of --variable_header. default: [None], no tests',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--permutations',
+                        nargs = '?',
+                        help = 'Specify the number of label permutations for p-values of small groups. default: [9999]',
+                        type = int,
+                        default = 9999)
+
+    parser.add_argument('--permutation_max_size',
+                        nargs = '?',
+                        help = 'Specify the group size up to which p-values are estimated by permutations instead of asymptotic distributions, \
+                                i.e. a pair is permuted if its smaller group has at most this many values. default: [50]',
+                        type = int,
+                        default = 50)
+
+    parser.add_argument('--p_adjust',
+                        nargs = '?',
+                        help = 'Specify the multiple testing correction applied across pairs for each test, any method of statsmodels multipletests, \
+                                e.g. <fdr_bh>/<bonferroni>/<holm>. default: [fdr_bh]',
+                        type = str,
+                        default = 'fdr_bh')
+
+    parser.add_argument('--seed',
+                        nargs = '?',
+                        help = 'Specify the random seed of permutations. default: [0]',
+                        type = int,
+                        default = 0)
   
                                 
     return vars(parser.parse_args())
 
 def EvalCdf(sample, x):
-    count = 0.0
-    for value in sample:
-        if value <= x:
-            count += 1
-    prob = count / len(sample)
-    return prob
-
-def make_cdf_table(input_df, value_header, variable_header = None):
-    cutoffs = np.linspace(0, max(input_df[value_header].to_list()), 10)
-    if variable_header:
-        groups = set(input_df[variable_header].to_list())
-        cdf_dfs = []
-        for group in groups:
-            group_df = pd.DataFrame([[group, cutoff, EvalCdf(input_df[input_df[variable_header] == group][value_header].to_list(), cutoff)] for cutoff in cutoffs],
-                              columns = [variable_header, "Cutoffs", "CDFs"])
-            cdf_dfs.append(group_df)
-        cdf_df = pd.concat(cdf_dfs)
-        
-    else:
-        cdf_df = pd.DataFrame([[cutoff, EvalCdf(input_df[value_header].to_list(), cutoff)] for cutoff in cutoffs],
-                              columns = ["Cutoffs", "CDFs"])
+    # sample: the values of one group.
+    # x: a cutoff or an array of cutoffs.
+    # this function is to return the fraction of values in the sample which are <= x.
+    sorted_sample = np.sort(np.asarray(sample))
+    return np.searchsorted(sorted_sample, x, side = 'right') / len(sorted_sample)
+
+def sorted_groups(input_df, value_header, variable_header = None):
+    # input_df: the input dataframe.
+    # value_header: the column of values.
+    # variable_header: the column of groups, None for treating all values as one group.
+    # this function is to return a dictionary mapping each group (None without groups) to its sorted values,
+    # sorting all values once by (group, value) and cutting the result at group boundaries.
+
+    values = input_df[value_header].to_numpy(dtype = np.float64)
+    if not variable_header:
+        return {None: np.sort(values)}
+    codes, groups = pd.factorize(input_df[variable_header])
+    order = np.lexsort((values, codes))
+    bounds = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+    sorted_values = values[order]
+
+    return {group: sorted_values[bounds[i]: bounds[i + 1]] for i, group in enumerate(groups)}
+
+def ecdf(sorted_values, cutoffs = None):
+    # sorted_values: the sorted values of one group.
+    # cutoffs: the cutoffs to evaluate, None for every distinct value, i.e. every step of the exact curve.
+    # this function is to evaluate the empirical CDF by binary search in the sorted values.
+
+    if cutoffs is None:
+        cutoffs = np.unique(sorted_values)
+
+    return cutoffs, np.searchsorted(sorted_values, cutoffs, side = 'right') / len(sorted_values)
+
+def make_cdf_table(input_df, value_header, variable_header = None, n_cutoffs = 10, exact = False, groups = None):
+    # n_cutoffs: the number of evenly spaced cutoffs between 0 and the maximum value.
+    # exact: evaluate the CDF at every distinct value of each group instead of the evenly spaced cutoffs.
+    # groups: the sorted values of each group from sorted_groups, computed from input_df if not given.
+    # this function is to tabulate the CDF of each group, with columns [variable_header,] Cutoffs and CDFs.
+
+    if groups is None:
+        groups = sorted_groups(input_df, value_header, variable_header)
+    cutoffs = None if exact else np.linspace(0, input_df[value_header].max(), n_cutoffs)
+    cdf_dfs = []
+    for group, sorted_values in groups.items():
+        group_cutoffs, cdfs = ecdf(sorted_values, cutoffs)
+        group_df = pd.DataFrame({"Cutoffs": group_cutoffs, "CDFs": cdfs})
+        if variable_header:
+            group_df.insert(0, variable_header, group)
+        cdf_dfs.append(group_df)
     
-    return cdf_df    
+    return pd.concat(cdf_dfs, ignore_index = True)
+
+def merge_sorted(x, y):
+    # x, y: the sorted values of two groups.
+    # this function is to merge two sorted arrays in linear time, returning the pooled sorted values and a boolean array
+    # marking values coming from y, so that tests reuse the sorted groups without sorting again.
+
+    positions = np.searchsorted(x, y, side = 'right') + np.arange(len(y)) # positions of y values in the pooled array
+    from_y = np.zeros(len(x) + len(y), dtype = bool)
+    from_y[positions] = True
+    pooled = np.empty(len(x) + len(y))
+    pooled[from_y] = y
+    pooled[~from_y] = x
+
+    return pooled, from_y
+
+def pair_statistics(pooled, labels, n_x, n_y):
+    # pooled: the pooled sorted values.
+    # labels: a 2D boolean array, one row per (permuted) labeling marking values assigned to the second group.
+    # this function is to compute the two-sample KS statistic and the centered rank sum of the first group for every labeling.
+    # ECDF differences are only compared at the last value of each run of ties, and tied values share their mid-rank.
+
+    last_of_ties = np.append(pooled[1:] != pooled[:-1], True)
+    from_y = np.cumsum(labels, axis = 1)[:, last_of_ties]
+    from_x = np.flatnonzero(last_of_ties)[np.newaxis, :] + 1 - from_y
+    ks = np.abs(from_x / n_x - from_y / n_y).max(axis = 1)
+    starts = np.searchsorted(pooled, pooled, side = 'left')
+    ends = np.searchsorted(pooled, pooled, side = 'right')
+    mid_ranks = (starts + ends + 1) / 2
+    rank_sums = (~labels).astype(np.float64) @ mid_ranks - n_x * (n_x + n_y + 1) / 2
+
+    return ks, rank_sums
+
+def pairwise_tests(groups, permutations = 9999, permutation_max_size = 50, p_adjust = 'fdr_bh', seed = 0,
+                   block_elements = 2 ** 22):
+    # groups: a dictionary mapping group names to sorted values, from sorted_groups.
+    # permutations: the number of label permutations for pairs with small groups.
+    # permutation_max_size: pairs whose smaller group has at most this many values get permutation p-values.
+    # p_adjust: the multiple testing correction applied to each test across all pairs.
+    # seed: the seed of permutations.
+    # block_elements: the approximate number of (permutation x value) cells handled at once.
+    # this function is to run two-sample KS and Wilcoxon rank-sum tests on every pair of groups. Without permutations,
+    # p-values come from the asymptotic distributions (as in scipy ks_2samp with method asymp and scipy ranksums).
+
+    from scipy.stats import kstwo, norm
+    from statsmodels.stats.multitest import multipletests
+
+    results_matrix = []
+    for group_x, group_y in itertools.combinations(groups, 2):
+        x, y = groups[group_x], groups[group_y]
+        n_x, n_y = len(x), len(y)
+        pooled, from_y = merge_sorted(x, y)
+        ks, rank_sum = [i[0] for i in pair_statistics(pooled, from_y[np.newaxis, :], n_x, n_y)]
+        z = rank_sum / np.sqrt(n_x * n_y * (n_x + n_y + 1) / 12)
+        if min(n_x, n_y) <= permutation_max_size and permutations > 0:
+            stream_key = random_stream_key(group_x, group_y)
+            ks_count, rank_sum_count = 0, 0
+            for block_index, block_permutations in permutation_blocks(permutations, max(1, block_elements // len(pooled))):
+                labels = permuted_labels(from_y, block_permutations, seed, stream_key, block_index)
+                permuted_ks, permuted_rank_sums = pair_statistics(pooled, labels, n_x, n_y)
+                ks_count += np.count_nonzero(permuted_ks >= ks - 1e-12)
+                rank_sum_count += np.count_nonzero(np.abs(permuted_rank_sums) >= abs(rank_sum) - 1e-9)
+            ks_p = (ks_count + 1) / (permutations + 1)
+            rank_sum_p = (rank_sum_count + 1) / (permutations + 1)
+            p_method = 'permutation'
+        else:
+            ks_p = float(kstwo.sf(ks, np.round(n_x * n_y / (n_x + n_y))))
+            rank_sum_p = float(2 * norm.sf(abs(z)))
+            p_method = 'asymptotic'
+        results_matrix.append([group_x, group_y, n_x, n_y, 'ks', ks, ks_p, p_method])
+        results_matrix.append([group_x, group_y, n_x, n_y, 'ranksums', z, rank_sum_p, p_method])
+
+    tests_df = pd.DataFrame(results_matrix, columns = ['group1', 'group2', 'n1', 'n2', 'test', 'statistic', 'p-value', 'p_method'])
+    tests_df['adjusted_p-value'] = np.nan
+    for test in ['ks', 'ranksums']:
+        mask = tests_df['test'] == test
+        if mask.any():
+            tests_df.loc[mask, 'adjusted_p-value'] = multipletests(tests_df.loc[mask, 'p-value'], method = p_adjust)[1]
+
+    return tests_df
 
 class VisualTools:
     def __init__(self, processed_df):
         self.processed_df = processed_df
 
-    def step_curves(self, opt_name, variable_header = None, palette = None, font_type = "Arial", font_size = 11):
+    def step_curves(self, opt_name, variable_header = None, palette = None, font_type = "Arial", font_size = 11, exact = False):
+        # exact: the table holds every step of exact CDFs, drawn as right-continuous steps rising from zero.
+        import matplotlib
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots()
         font_family = 'sans-serif'
         matplotlib.rcParams['font.family'] = font_family 
         matplotlib.rcParams['font.{}'.format(font_family)] = font_type
+        palette_dict = {}
         if palette:
             palette_dict = {i.rstrip().split('\t')[0]: i.rstrip().split('\t')[1] for i in open(palette).readlines()}
-            if variable_header:
-                categories = list(set(self.processed_df[variable_header].to_list()))
-                for c in categories:
-                    sub_df = self.processed_df[self.processed_df[variable_header] == c]
-                    plt.step(sub_df["Cutoffs"], sub_df["CDFs"], label = c, color = palette_dict[c])
-            else:
-                plt.step(self.processed_df["Cutoffs"], self.processed_df["CDFs"])                
+        if variable_header:
+            categories = list(dict.fromkeys(self.processed_df[variable_header].to_list()))
+            for c in categories:
+                sub_df = self.processed_df[self.processed_df[variable_header] == c]
+                self.draw_step(ax, sub_df, exact, label = c, color = palette_dict.get(c))
         else:
-            if variable_header:
-                categories = list(set(self.processed_df[variable_header].to_list()))
-                for c in categories:
-                    sub_df = self.processed_df[self.processed_df[variable_header] == c]
-                    plt.step(sub_df["Cutoffs"], sub_df["CDFs"], label = c)
-            else:
-                plt.step(self.processed_df["Cutoffs"], self.processed_df["CDFs"])
+            self.draw_step(ax, self.processed_df, exact)
         plt.xlabel("Values", fontsize = font_size)
         plt.ylabel("Cumulative distribution function", fontsize = font_size)
         if variable_header:
@@ -129,17 +277,45 @@ class VisualTools:
         plt.xticks(fontsize = font_size)
         plt.yticks(fontsize = font_size)
         fig.savefig(opt_name, bbox_inches = "tight")
+        plt.close(fig)
+
+    def draw_step(self, ax, sub_df, exact = False, **kwargs):
+        # this function is to draw the CDF of one group, kwargs are passed to matplotlib step.
+        if exact:
+            cutoffs = np.concatenate([sub_df["Cutoffs"].to_numpy()[:1], sub_df["Cutoffs"].to_numpy()])
+            cdfs = np.concatenate([[0.0], sub_df["CDFs"].to_numpy()])
+            ax.step(cutoffs, cdfs, where = "post", **kwargs)
+        else:
+            ax.step(sub_df["Cutoffs"], sub_df["CDFs"], **kwargs)
 
 
 if __name__ == "__main__":    
     pars = read_args(sys.argv)
+    if not pars["input_table"] or not os.path.isfile(pars["input_table"]):
+        sys.exit("Please input an existing table with --input_table!")
+    if not pars["value_header"] or not pars["output_figure"]:
+        sys.exit("Please specify the column of values with --value_header and the output figure with --output_figure!")
+    if pars["test_output"] and not pars["variable_header"]:
+        sys.exit("Please specify --variable_header for testing differences between groups!")
     input_df = pd.read_csv(pars["input_table"], sep = "\t", index_col = False)    
+    groups = sorted_groups(input_df, pars["value_header"], pars["variable_header"])
     CDF_df = make_cdf_table(input_df,
                             pars["value_header"],
-                            pars["variable_header"])      
+                            pars["variable_header"],
+                            n_cutoffs = pars["n_cutoffs"],
+                            exact = pars["exact"],
+                            groups = groups)      
     vis_obj = VisualTools(CDF_df)
     vis_obj.step_curves(pars["output_figure"], 
                         pars["variable_header"], 
                         pars["palette_map"],
                         pars["font_style"],
-                        pars["font_size"])
\ No newline at end of file
+                        pars["font_size"],
+                        exact = pars["exact"])
+    if pars["test_output"]:
+        tests_df = pairwise_tests(groups,
+                                  permutations = pars["permutations"],
+                                  permutation_max_size = pars["permutation_max_size"],
+                                  p_adjust = pars["p_adjust"],
+                                  seed = pars["seed"])
+        tests_df.to_csv(pars["test_output"], sep = "\t", index = False)
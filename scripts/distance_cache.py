@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+NAME: distance_cache.py
+DESCRIPTION: distance_cache.py is a python module for an on-disk, content-addressed cache of beta diversity results.
+             Entries are keyed by the hash of the abundance file plus the parameters used for computing distances, and
+             hold the condensed distance matrix and PCoA results as .npy files which are memory-mapped when loaded.
+             The cache is bounded in size, least recently used entries are evicted first.
+DATE: 14.03.2024
+"""
+
+from mpa_reader import is_mpa_store, store_checksum
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+class DistanceCache:
+
+    """
+    This object is to store and retrieve distance matrices and PCoA results on disk.
+    """
+
+    def __init__(self, cache_dir, max_size_mb = 1024):
+        # cache_dir: the directory holding cache entries, created if missing.
+        # max_size_mb: the maximum total size of the cache in megabytes.
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def make_key(self, abundance_table, **params):
+        # abundance_table: the path to the abundance file, its content is hashed; for a binary store its recorded checksum is used.
+        # params: the parameters affecting the distances, e.g. metric, transformation and amplifier.
+        # this function is to derive the content-addressed key of a cache entry.
+
+        digest = hashlib.sha256()
+        if is_mpa_store(abundance_table):
+            digest.update(store_checksum(abundance_table).encode())
+        else:
+            with open(abundance_table, 'rb') as table:
+                for chunk in iter(lambda: table.read(1 << 20), b''):
+                    digest.update(chunk)
+        digest.update(json.dumps(params, sort_keys = True, default = str).encode())
+
+        return digest.hexdigest()
+
+    def entry_dir(self, key):
+        # this function is to return the directory of a cache entry.
+        return os.path.join(self.cache_dir, key)
+
+    def _entry_size(self, key):
+        # this function is to return the total size of files in a cache entry.
+        entry = self.entry_dir(key)
+        return sum(os.path.getsize(os.path.join(entry, i)) for i in os.listdir(entry))
+
+    def _touch(self, key):
+        # this function is to mark an entry as recently used.
+        os.utime(self.entry_dir(key))
+
+    def _write_arrays(self, key, arrays, texts = {}):
+        # arrays: a dictionary mapping file names to numpy arrays.
+        # texts: a dictionary mapping file names to lists of strings, written one per line.
+        # this function is to write files of an entry atomically, so interrupted runs never leave half-written files.
+
+        entry = self.entry_dir(key)
+        os.makedirs(entry, exist_ok = True)
+        for name, array in arrays.items():
+            fd, tmp = tempfile.mkstemp(dir = entry, suffix = '.npy')
+            with os.fdopen(fd, 'wb') as opt:
+                np.save(opt, np.ascontiguousarray(array))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, os.path.join(entry, name))
+        for name, lines in texts.items():
+            fd, tmp = tempfile.mkstemp(dir = entry, suffix = '.txt')
+            with os.fdopen(fd, 'w') as opt:
+                opt.write("".join(str(i) + "\n" for i in lines))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, os.path.join(entry, name))
+        self._touch(key)
+        self.evict(keep = key)
+
+    def load_distance_matrix(self, key):
+        # this function is to return the cached skbio DistanceMatrix of an entry, or None if it is not cached.
+
+        entry = self.entry_dir(key)
+        condensed_file = os.path.join(entry, 'distances.npy')
+        ids_file = os.path.join(entry, 'ids.txt')
+        if not (os.path.exists(condensed_file) and os.path.exists(ids_file)):
+            return None
+        from skbio.stats.distance import DistanceMatrix # imported on use, opening a cache does not need scikit-bio
+        from scipy.spatial.distance import squareform
+
+        condensed = np.load(condensed_file, mmap_mode = 'r')
+        ids = [i.rstrip('\n') for i in open(ids_file).readlines()]
+        self._touch(key)
+
+        return DistanceMatrix(squareform(condensed, checks = False), ids)
+
+    def save_distance_matrix(self, key, distance_matrix):
+        # this function is to store a skbio DistanceMatrix as its condensed form plus sample ids.
+        self._write_arrays(key, {'distances.npy': distance_matrix.condensed_form()},
+                           {'ids.txt': list(distance_matrix.ids)})
+
+    def load_pcoa(self, key, method = 'eigh'):
+        # method: the PCoA method the results were computed with.
+        # this function is to return cached sample ids, PCoA coordinates, eigenvalues and proportions explained, or None if not cached.
+
+        entry = self.entry_dir(key)
+        ids_file = os.path.join(entry, 'ids.txt')
+        files = [os.path.join(entry, 'pcoa_{}_{}.npy'.format(method, i)) for i in ['coordinates', 'eigvals', 'proportion_explained']]
+        if not all(os.path.exists(i) for i in files + [ids_file]):
+            return None
+        ids = [i.rstrip('\n') for i in open(ids_file).readlines()]
+        self._touch(key)
+
+        return (ids,) + tuple(np.load(i, mmap_mode = 'r') for i in files)
+
+    def save_pcoa(self, key, ids, coordinates, eigvals, proportion_explained, method = 'eigh'):
+        # this function is to store sample ids, PCoA coordinates (samples x axes), eigenvalues and proportions explained.
+        self._write_arrays(key, {'pcoa_{}_coordinates.npy'.format(method): coordinates,
+                                 'pcoa_{}_eigvals.npy'.format(method): eigvals,
+                                 'pcoa_{}_proportion_explained.npy'.format(method): proportion_explained},
+                           {'ids.txt': list(ids)})
+
+    def evict(self, keep = None):
+        # keep: the key of an entry which must not be evicted, e.g. the one just written.
+        # this function is to remove least recently used entries until the cache fits into its size limit.
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self.entry_dir(key)
+            if os.path.isdir(entry) and key != keep:
+                entries.append((os.path.getmtime(entry), self._entry_size(key), entry))
+        total_size = sum(i[1] for i in entries)
+        if keep and os.path.isdir(self.entry_dir(keep)):
+            total_size += self._entry_size(keep)
+        for mtime, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors = True)
+            total_size -= size
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+NAME: distance_engine.py
+DESCRIPTION: distance_engine.py is a python module to compute condensed Bray-Curtis and Jaccard (presence/absence)
+             distance matrices (same definitions as scipy.spatial.distance) for large abundance matrices. Rows are split into blocks
+             with about the same number of pairs which are spread across a thread or process pool, dense float32/float64
+             and sparse CSR inputs are supported, and results are written into a preallocated or memory-mapped output
+             so that peak memory stays bounded.
+DATE: 21.03.2024
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy import sparse
+import numpy as np
+import os
+import tempfile
+
+SUPPORTED_METRICS = ['braycurtis', 'jaccard']
+
+_shared_input = {} # the abundance matrix and output path living in each worker process of the pool.
+
+def condensed_index(i, n):
+    # this function is to return the position of pair (i, i + 1) in a condensed distance matrix of n samples.
+    return i * n - i * (i + 1) // 2
+
+def row_blocks(n, blocks):
+    # n: the number of samples.
+    # blocks: the number of row blocks wanted.
+    # this function is to split rows into contiguous blocks holding roughly the same number of pairs.
+
+    pairs_before = condensed_index(np.arange(n + 1), n)
+    targets = np.linspace(0, pairs_before[-1], blocks + 1)
+    bounds = np.unique(np.searchsorted(pairs_before, targets))
+    bounds[0], bounds[-1] = 0, n
+
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def _dense_row(X, row_sums, row_nnz, i, metric, chunk_elements):
+    # this function is to compute distances between row i and all following rows of a dense non-negative matrix.
+    # Only the columns where row i is non-zero are compared, the rest follows from row sums and non-zero counts.
+
+    u = X[i]
+    idx = np.flatnonzero(u)
+    values = u[idx]
+    opt = np.empty(X.shape[0] - i - 1)
+    chunk_rows = max(1, chunk_elements // max(len(idx), 1))
+    for start in range(i + 1, X.shape[0], chunk_rows):
+        end = min(start + chunk_rows, X.shape[0])
+        sub = X[start: end][:, idx]
+        if metric == 'braycurtis':
+            shared = np.minimum(sub, values).sum(axis = 1, dtype = np.float64)
+            total = row_sums[i] + row_sums[start: end]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                opt[start - i - 1: end - i - 1] = (total - 2 * shared) / total
+        else:
+            both = (sub != 0).sum(axis = 1)
+            union = row_nnz[i] + row_nnz[start: end] - both
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                opt[start - i - 1: end - i - 1] = np.where(union == 0, 0.0, (union - both) / union.astype(np.float64))
+
+    return opt
+
+def _sparse_row(X_csc, row_sums, row_nnz, i, metric, X_csr):
+    # this function is to compute distances between row i and all following rows of a sparse matrix.
+    # Only the columns where row i is non-zero are densified, which is cheap for sparse abundance profiles.
+
+    start, end = X_csr.indptr[i], X_csr.indptr[i + 1]
+    idx, values = X_csr.indices[start: end], X_csr.data[start: end]
+    sub = X_csc[:, idx][i + 1:].toarray() # following rows restricted to non-zero columns of row i
+    if metric == 'braycurtis':
+        shared = np.minimum(sub, values).sum(axis = 1, dtype = np.float64)
+        total = row_sums[i] + row_sums[i + 1:]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            opt = (total - 2 * shared) / total
+    else:
+        both = (sub != 0).sum(axis = 1)
+        union = row_nnz[i] + row_nnz[i + 1:] - both
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            opt = (union - both) / union.astype(np.float64)
+        opt[union == 0] = 0.0
+
+    return opt
+
+class _BlockWorker:
+
+    """
+    This object is to compute all rows of one row block and write them into the condensed output.
+    """
+
+    def __init__(self, X, metric, chunk_elements):
+        self.X = X
+        self.metric = metric
+        self.chunk_elements = chunk_elements
+        self.n = X.shape[0]
+        if sparse.issparse(X):
+            self.X_csr = sparse.csr_matrix(X)
+            self.X_csc = sparse.csc_matrix(X)
+            self.row_sums = np.asarray(self.X_csr.sum(axis = 1), dtype = np.float64).ravel()
+            self.row_nnz = np.diff(self.X_csr.indptr)
+        else:
+            self.row_sums = X.sum(axis = 1, dtype = np.float64)
+            self.row_nnz = np.count_nonzero(X, axis = 1)
+
+    def run(self, block, out):
+        start, end = block
+        for i in range(start, end):
+            if sparse.issparse(self.X):
+                values = _sparse_row(self.X_csc, self.row_sums, self.row_nnz, i, self.metric, self.X_csr)
+            else:
+                values = _dense_row(self.X, self.row_sums, self.row_nnz, i, self.metric, self.chunk_elements)
+            position = condensed_index(i, self.n)
+            out[position: position + len(values)] = values
+
+def _init_process_worker(X, metric, chunk_elements, out_path):
+    # this function is to set up the block worker and open the memory-mapped output once in each worker process.
+    _shared_input['worker'] = _BlockWorker(X, metric, chunk_elements)
+    _shared_input['out'] = np.load(out_path, mmap_mode = 'r+')
+
+def _run_process_block(block):
+    # this function is to run one row block inside a worker process.
+    _shared_input['worker'].run(block, _shared_input['out'])
+    _shared_input['out'].flush()
+
+def condensed_distances(X, metric = 'braycurtis', nproc = 1, backend = 'thread', out = None, chunk_elements = 2 ** 20):
+    # X: the non-negative samples x features abundance matrix, a dense numpy array (float32 or float64) or a scipy sparse matrix.
+    # metric: <braycurtis> or <jaccard>.
+    # nproc: the number of threads or processes computing row blocks.
+    # backend: <thread> shares the input and output in memory, <process> shares the output through a memory-mapped file.
+    # out: None, a preallocated condensed array, or a path of a .npy file to create as memory-mapped output.
+    # chunk_elements: the maximum number of matrix cells compared at once with one row.
+    # this function is to compute the condensed distance matrix (pairs ordered as in scipy.spatial.distance.pdist).
+
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError("Unsupported metric {}. Please choose from <braycurtis>/<jaccard>.".format(metric))
+    if backend not in ['thread', 'process']:
+        raise ValueError("Unsupported backend {}. Please choose from <thread>/<process>.".format(backend))
+    if sparse.issparse(X):
+        if X.nnz and X.data.min() < 0:
+            raise ValueError("Input must not contain negative abundances.")
+    else:
+        X = np.ascontiguousarray(X)
+        if X.dtype not in [np.float32, np.float64]:
+            X = X.astype(np.float64)
+        if X.size and X.min() < 0:
+            raise ValueError("Input must not contain negative abundances.")
+    n = X.shape[0]
+    pair_number = n * (n - 1) // 2
+    blocks = row_blocks(n, max(1, nproc) * 4)
+
+    out_path = None
+    tmp_path = None
+    if backend == 'process' and nproc > 1 and not isinstance(out, str):
+        fd, tmp_path = tempfile.mkstemp(suffix = '.npy')
+        os.close(fd)
+        out_path = tmp_path
+    elif isinstance(out, str):
+        out_path = out
+    if out_path is not None:
+        condensed = np.lib.format.open_memmap(out_path, mode = 'w+', dtype = np.float64, shape = (pair_number,))
+    elif out is None:
+        condensed = np.empty(pair_number)
+    else:
+        condensed = out
+
+    if backend == 'process' and nproc > 1:
+        condensed.flush()
+        with ProcessPoolExecutor(max_workers = nproc,
+                                 initializer = _init_process_worker,
+                                 initargs = (X, metric, chunk_elements, out_path)) as pool:
+            list(pool.map(_run_process_block, blocks))
+        condensed = np.load(out_path, mmap_mode = 'r+')
+    else:
+        worker = _BlockWorker(X, metric, chunk_elements)
+        if nproc > 1:
+            with ThreadPoolExecutor(max_workers = nproc) as pool:
+                list(pool.map(lambda block: worker.run(block, condensed), blocks))
+        else:
+            for block in blocks:
+                worker.run(block, condensed)
+
+    if tmp_path is not None:
+        if out is None:
+            condensed = np.array(condensed) # the caller asked for an in-memory result
+        else:
+            out[:] = condensed
+            condensed = out
+        os.remove(tmp_path)
+
+    return condensed
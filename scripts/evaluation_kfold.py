@@ -8,30 +8,21 @@ DATE: 09.08.2022
 AUTHOR: Kun D. Huang
 """
 
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
-from sklearn import metrics
-from collections import namedtuple
-from sklearn.calibration import CalibratedClassifierCV
-from sklearn.feature_selection import SelectFromModel
 import pandas as pd
-import itertools 
 import sys
+import os
 import argparse
 import textwrap
-import subprocess
-import random
 import numpy as np
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import roc_curve
-from sklearn.metrics import roc_auc_score
-import matplotlib.pyplot as plt
-from sklearn.metrics import auc
-from sklearn.metrics import RocCurveDisplay
-import matplotlib
+import zlib
+import time
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from mpa_reader import read_mpa_table, filter_features, filter_report, filter_error, FILTER_PARAMS
 
-matplotlib.rcParams['font.family'] = 'sans-serif'
-matplotlib.rcParams['font.sans-serif'] = 'Arial'
+# scikit-learn and matplotlib are imported by the functions using them, so that --help and argument errors
+# do not wait for them, and only the modules needed by the chosen mode are loaded.
 
 def read_args(args):
     # This function is to parse arguments
@@ -46,7 +37,7 @@ def read_args(args):
 
     parser.add_argument('--mpa_df',
                         nargs = '?',
-                        help = 'Input a mpa-style table with metadata being inserted.',
+                        help = 'Input a mpa-style table with metadata being inserted, plain, compressed by bzip2/gzip (.bz2/.gz) or converted by convert_mpa_table.py.',
                         type = str,
                         default = None)
 
@@ -99,18 +90,211 @@ def read_args(args):
 
     parser.add_argument('--nproc',
                         nargs = '?',
-                        help = 'Specify the number of processors you want to use. 4 by default.',
+                        help = 'Specify the number of processors you want to use. (repeat, fold) tasks are spread across processes and \
+                                processors left over are given to each random forest. 4 by default.',
                         type = int,
                         default = 4)
 
+    parser.add_argument('--seed',
+                        nargs = '?',
+                        help = 'Specify the random seed for splitting folds and fitting forests, the same seed gives the same results with any --nproc. 0 by default.',
+                        type = int,
+                        default = 0)
+
     parser.add_argument('--transform',
                         nargs = '?',
                         help = 'Transform values in the matrix, [arcsin_sqrt] or [binary] or [None]. [None] by default',
                         type = str,
                         default = None)
 
+    parser.add_argument('--eval_mode',
+                        nargs = '?',
+                        help = 'Specify how ROC-AUC is estimated. [cv]: repeated k-fold cross-validation; [oob]: out-of-bag predictions of one forest \
+                                fitted on all samples per repeat, no refits per fold; [warm_start]: like [oob] but trees are added --tree_step at a time \
+                                until the ROC-AUC changes less than --auc_tolerance; [nested]: repeated k-fold cross-validation whose forests are tuned \
+                                on inner folds of each training set by successive halving, see --search_n_estimators. [cv] by default',
+                        type = str,
+                        default = 'cv')
+
+    parser.add_argument('--tree_step',
+                        nargs = '?',
+                        help = 'Specify the number of trees added per step in [warm_start] mode. 100 by default.',
+                        type = int,
+                        default = 100)
+
+    parser.add_argument('--auc_tolerance',
+                        nargs = '?',
+                        help = 'Specify the ROC-AUC change between two steps below which [warm_start] mode stops adding trees. In [nested] mode, the smallest \
+                                --search_n_estimators budget whose inner ROC-AUC is within this tolerance of the largest one is chosen. 0.005 by default.',
+                        type = float,
+                        default = 0.005)
+
+    parser.add_argument('--manifest',
+                        nargs = '?',
+                        help = 'Input a tab-delimited manifest with columns target_row, pos_feature and neg_feature (optionally target, a name for the contrast) \
+                                to evaluate many contrasts in one run. The matrix is loaded once, all cross-validation jobs share one pool and ROC-AUC values \
+                                of all contrasts are merged into --output_values, no figure is drawn. --target_row, --pos_feature and --neg_feature are ignored.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--null_replicates',
+                        nargs = '?',
+                        help = 'Specify the number of label-shuffled replicates forming an empirical null distribution of the mean ROC-AUC. \
+                                Each replicate shuffles the labels once and is evaluated like one repeat. Null values are written next to --output_values \
+                                with suffix _null and the empirical P-value is shown in the figure. 0 (no null) by default.',
+                        type = int,
+                        default = 0)
+
+    parser.add_argument('--null_trees',
+                        nargs = '?',
+                        help = 'Specify the number of trees of forests fitted on shuffled labels, lighter forests make the null cheaper. \
+                                The same as the model (1000) by default.',
+                        type = int,
+                        default = None)
+
+    parser.add_argument('--importance_output',
+                        nargs = '?',
+                        help = 'Specify an output file for a ranked table of feature importances. Impurity importances of every fitted forest \
+                                are collected without refitting, averaged over folds within each repeat and reported as mean and std across repeats. None by default.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--permutation_repeats',
+                        nargs = '?',
+                        help = 'Specify the number of shuffles per feature for permutation importance (drop of ROC-AUC) on each held-out fold, \
+                                added to --importance_output. Only in [cv] mode. 0 (impurity importance only) by default.',
+                        type = int,
+                        default = 0)
+
+    parser.add_argument('--resume',
+                        help = 'Resume an interrupted run from its checkpoint, which is written next to --output_values with suffix _checkpoint. \
+                                Completed (repeat, fold) tasks are skipped; if all of them are completed, the figure and values are rebuilt without refitting.',
+                        action = 'store_true')
+
+    parser.add_argument('--clade_level',
+                        nargs = '?',
+                        help = 'Specify a MetaPhlAn rank letter, e.g. [s] or [t], to use only clades at that level as features. All rows by default.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--inner_folds',
+                        nargs = '?',
+                        help = 'Specify the number of inner folds splitting each training set in [nested] mode. 3 by default.',
+                        type = int,
+                        default = 3)
+
+    parser.add_argument('--search_n_estimators',
+                        nargs = '?',
+                        help = 'Specify the ascending numbers of trees of successive halving rungs in [nested] mode, comma delimited. All configurations \
+                                start with the smallest forests and only the best 1/--halving_factor of them go on to the next budget. 125,250,500,1000 by default.',
+                        type = str,
+                        default = '125,250,500,1000')
+
+    parser.add_argument('--search_max_features',
+                        nargs = '?',
+                        help = 'Specify candidate max_features of forests in [nested] mode, comma delimited: [sqrt], [log2], a fraction or a number of features. \
+                                sqrt,log2,0.2 by default.',
+                        type = str,
+                        default = 'sqrt,log2,0.2')
+
+    parser.add_argument('--search_min_samples_leaf',
+                        nargs = '?',
+                        help = 'Specify candidate min_samples_leaf of forests in [nested] mode, comma delimited. 1,3,5 by default.',
+                        type = str,
+                        default = '1,3,5')
+
+    parser.add_argument('--halving_factor',
+                        nargs = '?',
+                        help = 'Specify the factor by which the number of configurations is reduced after each rung in [nested] mode. 2 by default.',
+                        type = float,
+                        default = 2)
+
+    parser.add_argument('--min_prevalence',
+                        nargs = '?',
+                        help = 'Drop features present (abundance > 0) in less than this fraction of samples, e.g. [0.1], before the transform. \
+                                The feature filters are applied at load time to all samples, without looking at labels. No filter by default.',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--min_mean_abundance',
+                        nargs = '?',
+                        help = 'Drop features whose mean abundance across samples is below this value. No filter by default.',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--min_max_abundance',
+                        nargs = '?',
+                        help = 'Drop features whose maximum abundance across samples is below this value. No filter by default.',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--top_variance',
+                        nargs = '?',
+                        help = 'Keep only this number of features with the highest abundance variance among those passing the other filters. No filter by default.',
+                        type = int,
+                        default = None)
+
     return vars(parser.parse_args())
 
+def check_args(pars):
+    # pars: the parsed arguments.
+    # this function is to validate arguments and input paths before any heavy module is imported or any table is read.
+
+    if not pars["mpa_df"] or not os.path.exists(pars["mpa_df"]):
+        sys.exit("Please specify an existing input table or store with --mpa_df!")
+    if not pars["md_rows"]:
+        sys.exit("Please specify row numbers of wedged metadata with --md_rows!")
+    if not all(i.strip().isdigit() for i in pars["md_rows"].split(",")):
+        sys.exit("Please give --md_rows as comma delimited row numbers, e.g. <0,1,2>")
+    if pars["transform"] not in [None, 'None', 'arcsin_sqrt', 'binary']:
+        sys.exit("Please choose transform from <arcsin_sqrt>/<binary>")
+    if pars["eval_mode"] not in ['cv', 'oob', 'warm_start', 'nested']:
+        sys.exit("Please choose evaluation mode from <cv>/<oob>/<warm_start>/<nested>")
+    if pars["eval_mode"] in ['cv', 'nested'] and not pars["fold_number"]:
+        sys.exit("Please specify the number of folds with --fold_number!")
+    if not pars["repeat_time"]:
+        sys.exit("Please specify the number of repeats with --repeat_time!")
+    if not pars["output_values"]:
+        sys.exit("Please specify the output file of ROC-AUC values with --output_values!")
+    md_rows = [int(i) for i in pars["md_rows"].split(",")]
+    if pars["manifest"]:
+        if not os.path.isfile(pars["manifest"]):
+            sys.exit("Manifest {} is not found".format(pars["manifest"]))
+        if pars["null_replicates"] or pars["resume"] or pars["importance_output"]:
+            sys.exit("--null_replicates, --resume and --importance_output are only supported for a single contrast, not with --manifest")
+        target_rows = pd.read_csv(pars["manifest"], sep = "\t", dtype = str).get("target_row", pd.Series(dtype = str))
+        for target_row in target_rows.dropna():
+            if not target_row.strip().isdigit() or int(target_row) not in md_rows:
+                sys.exit("Manifest target row {} is not among --md_rows".format(target_row))
+    elif pars["target_row"] is None or not pars["pos_feature"] or not pars["neg_feature"] or not pars["output"]:
+        sys.exit("Please specify --target_row, --pos_feature, --neg_feature and --output, or a contrast --manifest!")
+    elif pars["target_row"] not in md_rows:
+        sys.exit("Target row {} is not among --md_rows {}".format(pars["target_row"], pars["md_rows"]))
+    if pars["permutation_repeats"] and (pars["eval_mode"] != 'cv' or not pars["importance_output"]):
+        sys.exit("Permutation importance needs held-out folds, please use it with --eval_mode cv and --importance_output")
+    if pars["null_replicates"] < 0 or (pars["null_trees"] is not None and pars["null_trees"] < 1):
+        sys.exit("Please give a non-negative --null_replicates and a positive --null_trees")
+    if pars["eval_mode"] == 'nested':
+        if pars["manifest"] or pars["null_replicates"] or pars["resume"] or pars["importance_output"]:
+            sys.exit("--manifest, --null_replicates, --resume and --importance_output are not supported with --eval_mode nested")
+        budgets = pars["search_n_estimators"].split(",")
+        if not all(i.strip().isdigit() and int(i) > 0 for i in budgets) or [int(i) for i in budgets] != sorted(set(int(i) for i in budgets)):
+            sys.exit("Please give --search_n_estimators as ascending numbers of trees, e.g. <125,250,500,1000>")
+        if not all(i in ['sqrt', 'log2', None] or (not isinstance(i, str) and i > 0) for i in parse_search_values(pars["search_max_features"])):
+            sys.exit("Please choose --search_max_features from <sqrt>/<log2>/<None>, fractions or numbers of features, e.g. <sqrt,log2,0.2>")
+        if not all(i.strip().isdigit() and int(i) > 0 for i in pars["search_min_samples_leaf"].split(",")):
+            sys.exit("Please give --search_min_samples_leaf as positive integers, e.g. <1,3,5>")
+        if pars["inner_folds"] < 2 or pars["halving_factor"] <= 1:
+            sys.exit("Please give --inner_folds of at least 2 and --halving_factor above 1")
+    if filter_error(feature_filter_params(pars)):
+        sys.exit(filter_error(feature_filter_params(pars)))
+
+def feature_filter_params(pars):
+    # pars: the parsed arguments.
+    # this function is to collect the feature filters given on the command line, see select_features in mpa_reader.py.
+
+    return {i: pars[i] for i in FILTER_PARAMS if pars[i] is not None}
+
 
 
 def get_df_dropping_metadata(mpa4_df, row_number_list):
@@ -125,44 +309,445 @@ def get_target_metadata(mpa4_df, row_number):
     # row_number: the integer indicating the row which contains the metadata one wants to examine.
     # this function is to get a list of binary metadata for establishing ML model.
     
-    features = mpa4_df.iloc[row_number].to_list()
+    features = mpa4_df.loc[row_number].to_list()
 
     return features
 
-def prepare_dataset(mpa4_style_md_df, pos_neg_dict, row_number_list, target_row, transform):
-    # mpa4_style_md_df: the merged metaphlan4 table with metadata being inseted.
+def load_mpa_table(mpa_df_file, row_number_list, clade_level = None, feature_filter = None):
+    # mpa_df_file: the merged metaphlan4 table with metadata being inseted, plain or compressed by bzip2/gzip.
+    # row_number_list: a list of row numbers containing metadata, zero-based without considering header row.
+    # clade_level: None for all abundance rows, or a rank letter (e.g. s or t) for keeping only clades at that level.
+    # feature_filter: a dictionary of feature filters applied right after loading, see filter_features in mpa_reader.py.
+    # this function is to split metadata rows from abundance rows while streaming the table, so that only metadata is kept as text.
+    # It returns a dataframe of metadata rows indexed by their row numbers, the samples x features float32 matrix and feature names.
+
+    table = read_mpa_table(mpa_df_file, md_rows = row_number_list, clade_level = clade_level, dtype = np.float32)
+    md_df = table.metadata.iloc[:, :len(table.metadata_rows)].T.reset_index() # wedged rows only, not columns of a metadata file
+    md_df.columns = [table.header] + table.samples
+    md_df.index = table.metadata_rows
+    if feature_filter:
+        table, report = filter_features(table, **feature_filter)
+        print(filter_report(report, len(table.samples)))
+    matrix = table.matrix
+    if not matrix.flags.writeable:
+        matrix = np.array(matrix) # a memory-mapped store is read-only, transforms work on a private copy
+
+    return md_df, matrix, table.features
+
+def transform_matrix(matrix, transform):
+    # matrix: the float32 samples x features matrix, transformed in place.
+    # transform: <arcsin_sqrt>, <binary> or None.
+    # this function is to transform abundance values without allocating another matrix.
+
+    if transform == 'arcsin_sqrt':
+        matrix /= 100
+        np.sqrt(matrix, out = matrix)
+        np.arcsin(matrix, out = matrix)
+    elif transform == 'binary':
+        np.copyto(matrix, 1, where = matrix > 0)
+
+    return matrix
+
+def prepare_matrix(mpa_df_file, row_number_list, transform, clade_level = None, feature_filter = None):
+    # mpa_df_file: the merged metaphlan4 table with metadata being inseted.
+    # row_number_list: a list of row numbers containing metadata.
+    # This function is to prepare the metadata and the transformed samples x features matrix, shared by all contrasts.
+
+    md_df, matrix, features = load_mpa_table(mpa_df_file, row_number_list, clade_level, feature_filter)
+
+    return md_df, transform_matrix(matrix, transform), features
+
+def prepare_dataset(mpa_df_file, pos_neg_dict, row_number_list, target_row, transform, clade_level = None, feature_filter = None):
+    # mpa_df_file: the merged metaphlan4 table with metadata being inseted.
     # pos_neg_dict: the dictionary which maps examine value to 1 or 0.
     # This function is to prepare dataset for downstream analysis.
+    # Samples labeled with neither the positive nor the negative feature are dropped.
+    # It returns the matrix, the labels and the names of matrix columns.
 
-    df_no_md = mpa4_style_md_df.drop(row_number_list)
-    sample_names = df_no_md.columns[1:].to_list()
-    matrix = []
-    for s in sample_names:
-        values = [float(i) for i in df_no_md[s].to_list()]
-        matrix.append(values)
+    md_df, X, feature_names = prepare_matrix(mpa_df_file, row_number_list, transform, clade_level, feature_filter)
+    features = pd.Series(get_target_metadata(md_df, target_row)[1:])
+    keep = features.isin(list(pos_neg_dict)).to_numpy()
+    if not keep.all():
+        print("{} samples labeled neither {} are dropped.".format((~keep).sum(), " nor ".join(pos_neg_dict)))
+        X = X[keep]
+    y = features[keep].map(pos_neg_dict).to_numpy()
 
-    matrix = np.array(matrix)
-    
-    if transform == 'arcsin_sqrt':
-        matrix = matrix/100
-        print(matrix)
-        matrix = np.arcsin(np.sqrt(matrix))
+    return X, y, feature_names
 
-    elif transform == 'binary':
-        matrix[np.where(matrix > 0)] = 1
+
+_shared_data = {} # the dataset and model living in each worker process of the pool.
+
+def share_array(X):
+    # X: a numpy array.
+    # this function is to copy an array into shared memory once, so that worker processes map it instead of receiving a copy.
+    # It returns the shared memory block, to be closed and unlinked by the caller, and a picklable descriptor of the array.
+
+    block = shared_memory.SharedMemory(create = True, size = max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype = X.dtype, buffer = block.buf)[:] = X
+
+    return block, (block.name, X.shape, X.dtype.str)
+
+def _init_worker(model, X, contrasts, importance = None):
+    # X: the value matrix, or the descriptor of a matrix in shared memory from share_array.
+    # contrasts: a dictionary mapping contrast keys to (sample indices or None for all samples, labels) pairs.
+    # importance: None, or the number of permutation importance shuffles (0 for impurity importance only) added to task results.
+    # this function is to hand the model and dataset over to a worker process once, instead of once per task.
+
+    if isinstance(X, tuple):
+        name, shape, dtype = X
+        _shared_data['block'] = shared_memory.SharedMemory(name = name) # kept referenced while the worker lives
+        X = np.ndarray(shape, dtype = dtype, buffer = _shared_data['block'].buf)
+    _shared_data['model'] = model
+    _shared_data['X'] = X
+    _shared_data['contrasts'] = contrasts
+    _shared_data['importance'] = importance
+
+def _contrast_data(key):
+    # this function is to return the matrix restricted to the samples of a contrast, with the labels of the contrast.
+
+    samples, y = _shared_data['contrasts'][key]
+    X = _shared_data['X']
+
+    return (X if samples is None else X[samples]), y
+
+def make_cv_tasks(y, fold, repeat, seed, key = None):
+    # y: the list of features, 1 and 0
+    # fold: the number of fold to split the dataset.
+    # repeat: the repeat number for splitting the dataset.
+    # seed: the seed from which split and forest seeds of every task are derived.
+    # key: the contrast the tasks belong to in batch mode.
+    # this function is to list all (repeat, fold) tasks with their train/test indices and their own forest seed,
+    # so that results do not depend on the order or the process in which tasks are run.
+
+    from sklearn.model_selection import StratifiedKFold
+
+    tasks = []
+    while repeat > 0:
+        repeat -= 1
+        split_seed = np.random.SeedSequence(seed, spawn_key = (repeat,)).generate_state(1)[0]
+        cv = StratifiedKFold(n_splits = fold, shuffle = True, random_state = int(split_seed))
+        for i, (train, test) in enumerate(cv.split(np.zeros(len(y)), y)):
+            forest_seed = np.random.SeedSequence(seed, spawn_key = (repeat, i)).generate_state(1)[0]
+            tasks.append((key, repeat, i, train, test, int(forest_seed)))
+
+    return tasks
+
+def roc_points(y_true, scores, mean_fpr = np.linspace(0, 1, 100)):
+    # y_true: the true labels, 1 and 0
+    # scores: the predicted probabilities of the positive label.
+    # mean_fpr: the common false positive rate grid on which true positive rates are interpolated.
+    # this function is to compute the interpolated ROC curve and the ROC-AUC directly, without any plotting object.
+
+    from sklearn.metrics import roc_curve, auc
+
+    fpr, tpr, thresholds = roc_curve(y_true, scores)
+    interp_tpr = np.interp(mean_fpr, fpr, tpr)
+    interp_tpr[0] = 0.0
+
+    return interp_tpr, auc(fpr, tpr)
+
+def permutation_importances(classifier, X_test, y_test, repeats, seed = 0, block_elements = 2 ** 24):
+    # classifier: a fitted forest.
+    # X_test, y_test: the held-out fold.
+    # repeats: the number of shuffles per feature.
+    # block_elements: the approximate number of matrix cells predicted at once.
+    # this function is to return the mean drop of held-out ROC-AUC when each feature is shuffled. Shuffled copies of the
+    # fold for many features are stacked and predicted in one call, so the forest is traversed once per block instead of
+    # once per (feature, shuffle), and ROC-AUCs of all copies are computed at once from ranks (Mann-Whitney U).
+    # Features which are constant within the fold cannot change any prediction and get 0 without being predicted.
+
+    from scipy.stats import rankdata
+
+    rng = np.random.default_rng(seed)
+    n_samples, n_features = X_test.shape
+    positives = y_test == 1
+    n_pos = positives.sum()
+    n_neg = n_samples - n_pos
+
+    def stacked_auc(scores):
+        ranks = rankdata(scores, axis = -1)
+        return (ranks[..., positives].sum(axis = -1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+    base_auc = stacked_auc(classifier.predict_proba(X_test)[:, 1])
+    drops = np.zeros(n_features)
+    varying = np.flatnonzero(X_test.max(axis = 0) > X_test.min(axis = 0))
+    block_features = max(1, block_elements // (n_samples * repeats * n_features))
+    for start in range(0, len(varying), block_features):
+        block = varying[start: start + block_features]
+        stacked = np.tile(X_test, (len(block) * repeats, 1))
+        for k, feature in enumerate(np.repeat(block, repeats)):
+            stacked[k * n_samples: (k + 1) * n_samples, feature] = X_test[rng.permutation(n_samples), feature]
+        scores = classifier.predict_proba(stacked)[:, 1].reshape(len(block), repeats, n_samples)
+        drops[block] = base_auc - stacked_auc(scores).mean(axis = 1)
+
+    return drops
+
+def forest_importances(classifier, X_test = None, y_test = None, seed = 0):
+    # classifier: a fitted forest.
+    # X_test, y_test: the held-out fold for permutation importance.
+    # this function is to return the importances asked for by the worker, one row per kind: the impurity importances
+    # of the forest, and with permutation shuffles the mean drop of held-out ROC-AUC, see permutation_importances.
+
+    importances = [classifier.feature_importances_]
+    if _shared_data['importance']:
+        importances.append(permutation_importances(classifier, X_test, y_test, _shared_data['importance'], seed))
+
+    return np.vstack(importances)
+
+def run_cv_task(task, inner_jobs = 1):
+    # task: a (contrast key, repeat, fold, train indices, test indices, forest seed) tuple from make_cv_tasks, optionally
+    #       followed by a dictionary of hyperparameters overriding those of the model, e.g. those chosen in [nested] mode.
+    # inner_jobs: the number of processors given to the random forest itself.
+    # this function is to fit the model on one training split and evaluate it on the held-out fold.
+
+    from sklearn.base import clone
+
+    key, repeat, i, train, test, forest_seed = task[:6]
+    params = task[6] if len(task) > 6 else {}
+    samples, y = _shared_data['contrasts'][key]
+    X = _shared_data['X']
+    train_rows, test_rows = (train, test) if samples is None else (samples[train], samples[test]) # rows of the shared matrix
+    classifier = clone(_shared_data['model']).set_params(random_state = forest_seed, n_jobs = inner_jobs, **params)
+    classifier.fit(X[train_rows], y[train])
+    interp_tpr, roc_auc = roc_points(y[test], classifier.predict_proba(X[test_rows])[:, 1])
+    if _shared_data['importance'] is not None:
+        return repeat, i, interp_tpr, roc_auc, forest_importances(classifier, X[test_rows], y[test], forest_seed)
+
+    return repeat, i, interp_tpr, roc_auc
+
+def make_oob_tasks(repeat, seed, tree_step = None, tolerance = 0.005, key = None):
+    # repeat: the number of forests to grow, each with its own seed.
+    # seed: the seed from which forest seeds are derived.
+    # tree_step: None to grow full forests at once, or the number of trees added per step in warm-start mode.
+    # tolerance: the ROC-AUC change between two steps below which a warm-started forest stops growing.
+    # key: the contrast the tasks belong to in batch mode.
+    # this function is to list all out-of-bag evaluation tasks.
+
+    tasks = []
+    while repeat > 0:
+        repeat -= 1
+        forest_seed = np.random.SeedSequence(seed, spawn_key = (repeat,)).generate_state(1)[0]
+        tasks.append((key, repeat, int(forest_seed), tree_step, tolerance))
+
+    return tasks
+
+def oob_roc_points(classifier, y):
+    # this function is to compute the ROC curve from out-of-bag predictions, skipping samples which were never out of bag.
+
+    scores = classifier.oob_decision_function_[:, 1]
+    evaluated = ~np.isnan(scores)
+
+    return roc_points(y[evaluated], scores[evaluated])
+
+def run_oob_task(task, inner_jobs = 1):
+    # task: a (contrast key, repeat, forest seed, tree step, tolerance) tuple from make_oob_tasks.
+    # inner_jobs: the number of processors given to the random forest itself.
+    # this function is to estimate ROC-AUC from out-of-bag predictions of one forest fitted on all samples.
+    # In warm-start mode trees are added tree_step at a time until the ROC-AUC changes less than tolerance
+    # or the number of trees of the model is reached.
+
+    from sklearn.base import clone
+
+    key, repeat, forest_seed, tree_step, tolerance = task
+    X, y = _contrast_data(key)
+    max_trees = _shared_data['model'].get_params()['n_estimators']
+    classifier = clone(_shared_data['model']).set_params(random_state = forest_seed, n_jobs = inner_jobs,
+                                                         bootstrap = True, oob_score = True)
+    if tree_step:
+        classifier.set_params(warm_start = True)
+        n_trees = 0
+        previous_auc = None
+        while n_trees < max_trees:
+            n_trees = min(n_trees + tree_step, max_trees)
+            classifier.set_params(n_estimators = n_trees)
+            classifier.fit(X, y)
+            interp_tpr, roc_auc = oob_roc_points(classifier, y)
+            if previous_auc is not None and abs(roc_auc - previous_auc) < tolerance:
+                break
+            previous_auc = roc_auc
     else:
-        matrix = matrix
+        n_trees = max_trees
+        classifier.fit(X, y)
+        interp_tpr, roc_auc = oob_roc_points(classifier, y)
+    if _shared_data['importance'] is not None:
+        return repeat, 'oob', interp_tpr, roc_auc, n_trees, forest_importances(classifier)
+
+    return repeat, 'oob', interp_tpr, roc_auc, n_trees
+
+def _run_task_in_worker(args):
+    # this function is to run one task inside a worker process.
+    task_func, task, inner_jobs = args
+    return task_func(task, inner_jobs)
+
+def make_tasks(y, eval_mode, fold, repeat, seed, tree_step = 100, tolerance = 0.005, key = None):
+    # eval_mode: <cv>, <oob> or <warm_start>.
+    # this function is to list the tasks of one contrast together with the function running them.
+
+    if eval_mode == 'cv':
+        return make_cv_tasks(y, fold, repeat, seed, key), run_cv_task
+    elif eval_mode in ['oob', 'warm_start']:
+        return make_oob_tasks(repeat, seed, tree_step if eval_mode == 'warm_start' else None, tolerance, key), run_oob_task
+    else:
+        sys.exit("Please choose evaluation mode from <cv>/<oob>/<warm_start>, [nested] runs through roc_auc_nested")
+
+def schedule_tasks(model, X, contrasts, tasks, nproc, task_func = run_cv_task, on_result = None, importance = None):
+    # contrasts: a dictionary mapping contrast keys to (sample indices or None for all samples, labels) pairs.
+    # nproc: the total number of processors.
+    # task_func: the function running one task, run_cv_task or run_oob_task.
+    # on_result: None, or a function called with each result as soon as its task finishes, e.g. to checkpoint it.
+    # importance: None, or the number of permutation importance shuffles, see _init_worker.
+    # this function is to run all tasks, splitting processors between parallel tasks (outer) and trees of each forest (inner).
+    # Worker processes map the matrix from shared memory, so it is copied once whatever the number of tasks and contrasts.
+
+    outer_jobs = max(1, min(nproc, len(tasks)))
+    inner_jobs = max(1, nproc // outer_jobs)
+    if outer_jobs == 1:
+        _init_worker(model, X, contrasts, importance)
+        results = []
+        for task in tasks:
+            results.append(task_func(task, inner_jobs))
+            if on_result:
+                on_result(results[-1])
+        return results
+    block, descriptor = share_array(np.ascontiguousarray(X))
+    try:
+        with ProcessPoolExecutor(max_workers = outer_jobs, initializer = _init_worker, initargs = (model, descriptor, contrasts, importance)) as pool:
+            futures = [pool.submit(_run_task_in_worker, (task_func, task, inner_jobs)) for task in tasks]
+            if on_result:
+                for future in as_completed(futures):
+                    on_result(future.result())
+            return [future.result() for future in futures]
+    finally:
+        block.close()
+        block.unlink()
+
+NULL_STREAM = zlib.crc32(b'label_permutation_null') # keeps seeds of null replicates apart from those of real repeats
+
+def null_values_file(output_values):
+    # this function is to name the null distribution file after the ROC-AUC values file, e.g. values.tsv -> values_null.tsv.
+
+    root, ext = os.path.splitext(output_values)
 
-    features = get_target_metadata(mpa4_style_md_df, target_row)[1:]
+    return root + "_null" + (ext or ".tsv")
 
-    X = np.asarray(matrix)
-    y = [pos_neg_dict[i] for i in features]
-    y = np.asarray(y)
+def roc_auc_null(model, X, y, fold, replicates, nproc = 1, seed = 0, eval_mode = 'cv', tree_step = 100,
+                 tolerance = 0.005, null_trees = None):
+    # replicates: the number of label-shuffled replicates.
+    # null_trees: None to fit the same forests as the model, or a smaller number of trees per forest.
+    # this function is to estimate the mean ROC-AUC of every replicate whose labels are shuffled once, keeping class
+    # sizes, and evaluated like one repeat. All tasks of all replicates share one pool, each replicate has its own
+    # label permutation and seeds derived from seed, so null values do not depend on nproc either.
 
-    return X, y
+    from sklearn.base import clone
 
+    contrasts = {}
+    tasks = []
+    for replicate in range(replicates):
+        key = ('null', replicate)
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (NULL_STREAM, replicate, 0)))
+        contrasts[key] = (None, rng.permutation(y))
+        replicate_seed = np.random.SeedSequence(seed, spawn_key = (NULL_STREAM, replicate, 1)).generate_state(1)[0]
+        replicate_tasks, task_func = make_tasks(contrasts[key][1], eval_mode, fold, 1, int(replicate_seed), tree_step, tolerance, key)
+        tasks += replicate_tasks
+    if null_trees:
+        model = clone(model).set_params(n_estimators = null_trees)
 
-def roc_auc_curve(model, X, y, fold, repeat, output_name, output_values):
+    auc_sums = np.zeros(replicates)
+    auc_counts = np.zeros(replicates)
+    for task, result in zip(tasks, schedule_tasks(model, X, contrasts, tasks, nproc, task_func)):
+        auc_sums[task[0][1]] += result[3]
+        auc_counts[task[0][1]] += 1
+
+    return auc_sums / auc_counts
+
+def empirical_p_value(observed, null_values):
+    # this function is to return the one-sided permutation P-value of an observed statistic, (#null >= observed + 1) / (#null + 1).
+    return (np.count_nonzero(null_values >= observed) + 1) / (len(null_values) + 1)
+
+def checkpoint_file(output_values):
+    # this function is to name the checkpoint file after the ROC-AUC values file, e.g. values.tsv -> values_checkpoint.tsv.
+
+    root, ext = os.path.splitext(output_values)
+
+    return root + "_checkpoint" + (ext or ".tsv")
+
+def task_ids(eval_mode, fold, repeat):
+    # this function is to list the (repeat, fold) identities of all tasks in the order of make_tasks, without needing labels.
+
+    if eval_mode == 'cv':
+        return [(r, i) for r in reversed(range(repeat)) for i in range(fold)]
+
+    return [(r, 'oob') for r in reversed(range(repeat))]
+
+def read_checkpoint(checkpoint, run_params):
+    # checkpoint: the checkpoint file.
+    # run_params: a dictionary of everything the results depend on, recorded in the first line of the checkpoint.
+    # this function is to return completed results keyed by (repeat, fold), as (repeat, fold, interpolated TPR, ROC-AUC, ...)
+    # tuples like those of run_cv_task and run_oob_task, with feature importances if they were recorded.
+    # A last line cut off by an interrupted write is ignored.
+
+    if not os.path.isfile(checkpoint):
+        return {}
+    lines = open(checkpoint).read().split("\n")
+    recorded = json.loads(lines[0].lstrip("#"))
+    if recorded != run_params:
+        changed = [i for i in sorted(set(recorded) | set(run_params)) if recorded.get(i) != run_params.get(i)]
+        sys.exit("Checkpoint {} was written with different {}, please remove it or rerun without --resume".format(checkpoint, ",".join(changed)))
+    header = lines[1].split("\t")
+    n_values = header.index("tpr_0")
+    n_tprs = len([i for i in header if i.startswith("tpr_")])
+    importance_kinds = len(dict.fromkeys(i.split("_")[0] for i in header[n_values + n_tprs:]))
+    completed = {}
+    for line in lines[2:-1]: # the last element follows the last newline, so it is empty or a cut-off line
+        fields = line.split("\t")
+        if len(fields) != len(header):
+            continue
+        fold = fields[1] if fields[1] == 'oob' else int(fields[1])
+        result = (int(fields[0]), fold, np.array(fields[n_values: n_values + n_tprs], dtype = np.float64), np.float64(fields[2]))
+        result += tuple(int(i) for i in fields[3:n_values])
+        if importance_kinds:
+            result += (np.array(fields[n_values + n_tprs:], dtype = np.float64).reshape(importance_kinds, -1),)
+        completed[(result[0], fold)] = result
+
+    return completed
+
+def open_checkpoint(checkpoint, run_params, header, completed):
+    # header: the column names of a checkpoint line.
+    # completed: the completed results kept from a previous run.
+    # this function is to (re)write the checkpoint with its parameters, header and the completed results, and return it opened
+    # for appending. It is written into a temporary file first, so that an interruption never destroys the previous checkpoint.
+
+    tmp_checkpoint = checkpoint + ".tmp"
+    with open(tmp_checkpoint, "w") as opt:
+        opt.write("#" + json.dumps(run_params, sort_keys = True) + "\n")
+        opt.write("\t".join(header) + "\n")
+        for result in completed.values():
+            opt.write(checkpoint_line(result))
+        opt.flush()
+        os.fsync(opt.fileno())
+    os.replace(tmp_checkpoint, checkpoint)
+
+    return open(checkpoint, "a")
+
+def checkpoint_line(result):
+    # this function is to format one result with full precision, so that values rebuilt from the checkpoint are exact.
+    # Feature importances, the last element of results when they are collected, follow the interpolated TPRs.
+    r, i, interp_tpr, roc_auc = result[:4]
+    extras = [str(v) for v in result[4:] if not isinstance(v, np.ndarray)]
+    importances = [repr(float(x)) for v in result[4:] if isinstance(v, np.ndarray) for x in v.ravel()]
+
+    return "\t".join([str(r), str(i), repr(float(roc_auc))] + extras + [repr(float(v)) for v in interp_tpr] + importances) + "\n"
+
+def append_checkpoint(checkpoint_opt, result):
+    # this function is to append one finished task to the checkpoint durably, before the next one is reported.
+
+    checkpoint_opt.write(checkpoint_line(result))
+    checkpoint_opt.flush()
+    os.fsync(checkpoint_opt.fileno())
+
+def roc_auc_curve(model, X, y, fold, repeat, output_name, output_values, nproc = 1, seed = 0,
+                  eval_mode = 'cv', tree_step = 100, tolerance = 0.005, null_replicates = 0, null_trees = None,
+                  run_params = None, completed = {}, importance_output = None, permutation_repeats = 0, features = None):
     # model: machine learning model to use.
     # X: the value matrix
     # y: the list of features, 1 and 0
@@ -170,46 +755,342 @@ def roc_auc_curve(model, X, y, fold, repeat, output_name, output_values):
     # repeat: the repeat number for splitting the dataset.
     # output_name: specify the output figure name.
     # outout_values: specify the output file name for storing estimated roc-auc values.
+    # nproc: the number of processors for running (repeat, fold) tasks.
+    # seed: the seed for splitting folds and fitting forests.
+    # eval_mode: <cv> for repeated k-fold cross-validation, <oob> for out-of-bag estimates of full forests,
+    #            <warm_start> for out-of-bag estimates of forests grown until the ROC-AUC stabilizes.
+    # tree_step, tolerance: the growing step and stopping tolerance of the <warm_start> mode.
+    # run_params: the parameters recorded in the checkpoint, see read_checkpoint.
+    # completed: results of a previous run read from the checkpoint, whose tasks are not run again. X and y may be None
+    #            if all tasks are completed and no null is asked for, the figure is then rebuilt without loading any data.
+    # Every finished task is appended to the checkpoint next to output_values as soon as it finishes.
+    # importance_output: None, or the output file of the ranked feature importance table, see importance_table.
+    # permutation_repeats: the number of shuffles per feature of held-out permutation importance, 0 for impurity importance only.
+    # features: the names of matrix columns.
 
-    cv = StratifiedKFold(n_splits=fold, shuffle=True)
-    classifier = model
-
-    tprs = []
-    aucs = []
     mean_fpr = np.linspace(0, 1, 100)
-    
+    ids = task_ids(eval_mode, fold, repeat)
+    position = {task_id: idx for idx, task_id in enumerate(ids)}
+    importance = permutation_repeats if importance_output else None
+    importance_kinds = ['impurity'] + (['permutation'] if permutation_repeats else [])
+    if importance is not None:
+        importances = np.empty((len(ids), len(importance_kinds), len(features))) # one slice per task, filled as tasks finish
+    header = ["repeat", "fold", "roc_auc"] + ([] if eval_mode == 'cv' else ["n_estimators"]) + ["tpr_" + str(i) for i in range(len(mean_fpr))]
+    if importance is not None:
+        header += [kind + "_" + str(i) for kind in importance_kinds for i in range(len(features))]
+    checkpoint_opt = open_checkpoint(checkpoint_file(output_values), run_params or {}, header, completed)
+    results = {}
+
+    def store(result):
+        if importance is not None:
+            importances[position[(result[0], result[1])]] = result[-1]
+            result = result[:-1]
+        results[(result[0], result[1])] = result
+
+    def collect(result):
+        store(result)
+        append_checkpoint(checkpoint_opt, result)
+
+    for result in completed.values():
+        store(result)
+
+    if len(results) < len(ids):
+        tasks, task_func = make_tasks(y, eval_mode, fold, repeat, seed, tree_step, tolerance)
+        tasks = [task for task, task_id in zip(tasks, ids) if task_id not in results]
+        print("{} of {} tasks are completed, {} are left to run.".format(len(ids) - len(tasks), len(ids), len(tasks)))
+        schedule_tasks(model, X, {None: (None, y)}, tasks, nproc, task_func, on_result = collect, importance = importance)
+    checkpoint_opt.close()
+
+    tprs = np.empty((len(ids), len(mean_fpr))) # interpolated TPRs, one row per task
+    aucs = np.empty(len(ids))
     rocauc_opt = open(output_values, "w")
+    if eval_mode == 'cv':
+        rocauc_opt.write("repeat"+ "\t" + "fold" + "\t" + "roc_auc" + "\n")
+    else:
+        rocauc_opt.write("repeat"+ "\t" + "fold" + "\t" + "roc_auc" + "\t" + "n_estimators" + "\n")
+    for idx, task_id in enumerate(ids):
+        r, i, interp_tpr, roc_auc = results[task_id][:4]
+        tprs[idx] = interp_tpr
+        aucs[idx] = roc_auc
+        rocauc_opt.write("\t".join([str(r), str(i), str(roc_auc)] + [str(v) for v in results[task_id][4:]]) + "\n")
 
-    rocauc_opt.write("repeat"+ "\t" + "fold" + "\t" + "roc_auc" + "\n")
-    while repeat > 0:
-        repeat -= 1
-        for i, (train, test) in enumerate(cv.split(X, y)):
-            classifier.fit(X[train], y[train])
-            viz = RocCurveDisplay.from_estimator(
-                classifier,
-                X[test],
-                y[test],
-                name="ROC fold {}".format(i),
-                alpha=0.3,
-                lw=1,
-            )
-            interp_tpr = np.interp(mean_fpr, viz.fpr, viz.tpr)
-            interp_tpr[0] = 0.0
-            tprs.append(interp_tpr)
-            aucs.append(viz.roc_auc)
-            rocauc_opt.write(str(repeat) + "\t" + str(i) + "\t" + str(viz.roc_auc) + "\n")
+    rocauc_opt.close()
+    if importance is not None:
+        importance_table(importances, importance_kinds, ids, features).to_csv(importance_output, sep = "\t", index = False)
+
+    null_p = None
+    if null_replicates:
+        null_aucs = roc_auc_null(model, X, y, fold, null_replicates, nproc, seed, eval_mode, tree_step, tolerance, null_trees)
+        null_p = empirical_p_value(np.mean(aucs), null_aucs)
+        pd.DataFrame({'replicate': np.arange(null_replicates), 'mean_roc_auc': null_aucs}).to_csv(null_values_file(output_values), sep = "\t", index = False)
+        print("Mean ROC-AUC {:.4f}, null mean {:.4f} (95% quantile {:.4f}), empirical P-value {:.4g} from {} label permutations".format(
+              np.mean(aucs), np.mean(null_aucs), np.quantile(null_aucs, 0.95), null_p, null_replicates))
+
+    plot_roc_curve(tprs, aucs, output_name, mean_fpr, null_p = null_p)
+
+def importance_table(importances, importance_kinds, ids, features):
+    # importances: the (task, kind, feature) array of importances collected from all fitted forests.
+    # importance_kinds: the kinds of importance, <impurity> and optionally <permutation>.
+    # ids: the (repeat, fold) identities of tasks, in the order of the first axis.
+    # features: the names of features.
+    # this function is to average importances over folds within each repeat and return a table of their mean and std
+    # across repeats, ranked by permutation importance if computed, otherwise by impurity importance.
+
+    repeats = np.array([task_id[0] for task_id in ids])
+    per_repeat = np.stack([importances[repeats == r].mean(axis = 0) for r in np.unique(repeats)]) # (repeat, kind, feature)
+    table = pd.DataFrame({'feature': features})
+    for k, kind in enumerate(importance_kinds):
+        table[kind + '_mean'] = per_repeat[:, k].mean(axis = 0)
+        table[kind + '_std'] = per_repeat[:, k].std(axis = 0)
+    table = table.sort_values(importance_kinds[-1] + '_mean', ascending = False, kind = 'stable')
+    table.insert(0, 'rank', np.arange(1, len(table) + 1))
+
+    return table
+
+def read_manifest(manifest_file, md_df):
+    # manifest_file: a tab-delimited file with columns target_row, pos_feature, neg_feature and optionally target.
+    # md_df: the metadata rows from load_mpa_table.
+    # this function is to turn every manifest line into a contrast: its name, its comparison label, the indices of samples
+    # labeled with either the positive or the negative feature, and their labels, 1 and 0.
+
+    manifest = pd.read_csv(manifest_file, sep = "\t", dtype = str)
+    missing = [i for i in ['target_row', 'pos_feature', 'neg_feature'] if i not in manifest.columns]
+    if missing:
+        sys.exit("Manifest {} misses column(s): {}".format(manifest_file, ",".join(missing)))
+    contrasts = []
+    for _, line in manifest.iterrows():
+        target_row = int(line['target_row'])
+        if target_row not in md_df.index:
+            sys.exit("Manifest target row {} is not among --md_rows".format(target_row))
+        features = np.asarray(get_target_metadata(md_df, target_row)[1:], dtype = object)
+        samples = np.flatnonzero((features == line['pos_feature']) | (features == line['neg_feature']))
+        y = (features[samples] == line['pos_feature']).astype(int)
+        if len(set(y)) < 2:
+            sys.exit("Manifest line with target row {} needs samples labeled {} and {}".format(target_row, line['pos_feature'], line['neg_feature']))
+        if 'target' in manifest.columns and pd.notna(line['target']):
+            target = line['target']
+        else:
+            target = md_df.loc[target_row].iloc[0]
+        contrasts.append((target, "{} vs. {}".format(line['pos_feature'], line['neg_feature']), samples, y))
+
+    return contrasts
+
+def roc_auc_batch(model, X, contrasts, fold, repeat, output_values, nproc = 1, seed = 0,
+                  eval_mode = 'cv', tree_step = 100, tolerance = 0.005):
+    # X: the value matrix of all samples, shared by every contrast.
+    # contrasts: a list of (target, comparison, sample indices, labels) tuples from read_manifest.
+    # output_values: specify the output file name for storing the merged roc-auc values of all contrasts.
+    # this function is to evaluate all contrasts with tasks scheduled on one pool, using the same seeds as single runs.
+
+    tasks = []
+    for key, (target, comparison, samples, y) in enumerate(contrasts):
+        contrast_tasks, task_func = make_tasks(y, eval_mode, fold, repeat, seed, tree_step, tolerance, key)
+        tasks += contrast_tasks
+    shared_contrasts = {key: (samples, y) for key, (target, comparison, samples, y) in enumerate(contrasts)}
+
+    rocauc_opt = open(output_values, "w")
+    header = ["target", "comparison", "repeat", "fold", "roc.auc"]
+    if eval_mode != 'cv':
+        header.append("n_estimators")
+    rocauc_opt.write("\t".join(header) + "\n")
+    for task, result in zip(tasks, schedule_tasks(model, X, shared_contrasts, tasks, nproc, task_func)):
+        target, comparison = contrasts[task[0]][:2]
+        r, i, interp_tpr, roc_auc = result[:4]
+        rocauc_opt.write("\t".join([str(target), comparison, str(r), str(i), str(roc_auc)] + [str(v) for v in result[4:]]) + "\n")
+    rocauc_opt.close()
+
+SEARCH_STREAM = zlib.crc32(b'nested_hyperparameter_search') # keeps seeds of inner splits and search forests apart from outer tasks
+
+SEARCH_PARAMS = ['max_features', 'min_samples_leaf']
+
+def search_values_file(output_values):
+    # this function is to name the search report after the ROC-AUC values file, e.g. values.tsv -> values_search.tsv.
+
+    root, ext = os.path.splitext(output_values)
+
+    return root + "_search" + (ext or ".tsv")
+
+def parse_search_values(values):
+    # values: a comma delimited list of candidates, e.g. sqrt,log2,0.2.
+    # this function is to parse candidate hyperparameter values into integers, fractions, None or names such as sqrt.
+
+    parsed = []
+    for value in values.split(","):
+        value = value.strip()
+        if value == 'None':
+            parsed.append(None)
+            continue
+        for value_type in [int, float, str]:
+            try:
+                parsed.append(value_type(value))
+                break
+            except ValueError:
+                pass
+
+    return parsed
+
+def search_space(max_features, min_samples_leaf):
+    # max_features, min_samples_leaf: lists of candidate values.
+    # this function is to list all candidate configurations, as dictionaries of hyperparameters, in grid order.
+
+    return [{'max_features': m, 'min_samples_leaf': l} for m in max_features for l in min_samples_leaf]
+
+def make_search_tasks(outer_tasks, y, configs, alive, budget, inner_folds, seed):
+    # outer_tasks: the (contrast key, repeat, fold, train indices, test indices, forest seed) tasks from make_cv_tasks.
+    # configs: the list of candidate configurations from search_space.
+    # alive: a dictionary mapping the (repeat, fold) of every outer task to the indices of configurations still in the race.
+    # budget: the number of trees of every forest in this rung.
+    # inner_folds: the number of folds splitting each outer training set.
+    # this function is to list the inner cross-validation tasks of one successive halving rung for all outer tasks. Inner
+    # splits and forest seeds are derived from seed, so the search depends neither on nproc nor on which rung a task is in.
 
+    from sklearn.model_selection import StratifiedKFold
+
+    tasks = []
+    for key, repeat, i, train, test, forest_seed in outer_tasks:
+        split_seed = np.random.SeedSequence(seed, spawn_key = (SEARCH_STREAM, repeat, i)).generate_state(1)[0]
+        cv = StratifiedKFold(n_splits = inner_folds, shuffle = True, random_state = int(split_seed))
+        for j, (inner_train, inner_test) in enumerate(cv.split(np.zeros(len(train)), y[train])):
+            for c in alive[(repeat, i)]:
+                inner_seed = np.random.SeedSequence(seed, spawn_key = (SEARCH_STREAM, repeat, i, j, c)).generate_state(1)[0]
+                tasks.append(((repeat, i), c, j, dict(configs[c], n_estimators = budget), train[inner_train], train[inner_test], int(inner_seed)))
+
+    return tasks
+
+def run_search_task(task, inner_jobs = 1):
+    # task: an (outer task, configuration index, inner fold, hyperparameters, train indices, validation indices, forest seed)
+    #       tuple from make_search_tasks.
+    # inner_jobs: the number of processors given to the random forest itself.
+    # this function is to fit one candidate forest on an inner training split and return its validation ROC-AUC, with the
+    # wall-clock and CPU time (of all threads of this worker) spent fitting and predicting.
+
+    from sklearn.base import clone
+
+    outer_id, c, j, params, train, test, forest_seed = task
+    X, y = _contrast_data(None)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    classifier = clone(_shared_data['model']).set_params(random_state = forest_seed, n_jobs = inner_jobs, **params)
+    classifier.fit(X[train], y[train])
+    roc_auc = roc_points(y[test], classifier.predict_proba(X[test])[:, 1])[1]
+
+    return outer_id, c, j, roc_auc, time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+def successive_halving(model, X, y, outer_tasks, configs, budgets, inner_folds = 3, halving_factor = 2, nproc = 1, seed = 0):
+    # outer_tasks: the outer (repeat, fold) tasks from make_cv_tasks, each searched on its own training set only.
+    # configs: the list of candidate configurations from search_space.
+    # budgets: the ascending numbers of trees of the rungs.
+    # this function is to race configurations on inner folds: every rung fits the configurations still alive with the rung's
+    # number of trees, and only the best 1/halving_factor by mean inner ROC-AUC (ties keep grid order) go on to the next rung,
+    # so only promising configurations get the largest forests. Inner tasks of all outer tasks in a rung share one pool.
+    # It returns a dataframe with one row per (outer task, rung, configuration) and the winner of every outer task.
+
+    ids = [(task[1], task[2]) for task in outer_tasks]
+    alive = {task_id: list(range(len(configs))) for task_id in ids}
+    records = []
+    for rung, budget in enumerate(budgets):
+        tasks = make_search_tasks(outer_tasks, y, configs, alive, budget, inner_folds, seed)
+        totals = {}
+        for outer_id, c, j, roc_auc, wall, cpu in schedule_tasks(model, X, {None: (None, y)}, tasks, nproc, run_search_task):
+            totals[(outer_id, c)] = totals.get((outer_id, c), np.zeros(3)) + (roc_auc / inner_folds, wall, cpu)
+        last = rung == len(budgets) - 1
+        for task_id in ids:
+            ranked = sorted(alive[task_id], key = lambda c: -totals[(task_id, c)][0])
+            kept = ranked[:1] if last else ranked[:max(1, int(np.ceil(len(ranked) / halving_factor)))]
+            for c in alive[task_id]:
+                status = ('selected' if last else 'promoted') if c in kept else 'dropped'
+                records.append(list(task_id) + [rung, budget, c] + [str(configs[c][k]) for k in SEARCH_PARAMS] + list(totals[(task_id, c)]) + [status])
+            alive[task_id] = sorted(kept)
+    search_df = pd.DataFrame(records, columns = ['repeat', 'fold', 'rung', 'n_estimators', 'config'] + SEARCH_PARAMS +
+                                                ['inner_roc_auc', 'wall_seconds', 'cpu_seconds', 'status'])
+
+    return search_df, {task_id: alive[task_id][0] for task_id in ids}
+
+def chosen_n_estimators(search_df, task_id, config, tolerance = 0.005):
+    # this function is to choose the number of trees of a winning configuration: the smallest rung budget whose mean inner
+    # ROC-AUC is within tolerance of that of the largest budget, which all winners reach.
+
+    rungs = search_df[(search_df['repeat'] == task_id[0]) & (search_df['fold'] == task_id[1]) & (search_df['config'] == config)]
+    enough = rungs['inner_roc_auc'] >= rungs['inner_roc_auc'].iloc[-1] - tolerance
+
+    return int(rungs.loc[enough, 'n_estimators'].iloc[0])
+
+def roc_auc_nested(model, X, y, fold, repeat, output_name, output_values, nproc = 1, seed = 0, configs = None,
+                   budgets = (125, 250, 500, 1000), inner_folds = 3, halving_factor = 2, tolerance = 0.005):
+    # configs: the list of candidate configurations from search_space, the model's own max_features and min_samples_leaf by default.
+    # budgets, inner_folds, halving_factor: the successive halving search, see successive_halving.
+    # tolerance: the inner ROC-AUC tolerance for choosing fewer trees than the largest budget, see chosen_n_estimators.
+    # this function is to estimate ROC-AUC by nested cross-validation. For every outer (repeat, fold) task, forests are tuned
+    # on the outer training set only and the winner is refitted on it and evaluated on the held-out fold, so the ROC-AUC is
+    # not biased by the search. Outer splits and refit seeds are those of [cv] mode. The race is written next to
+    # output_values with suffix _search, with wall-clock and CPU time per (outer task, rung, configuration).
+
+    if configs is None:
+        configs = [{k: model.get_params()[k] for k in SEARCH_PARAMS}]
+    outer_tasks = make_cv_tasks(y, fold, repeat, seed)
+    print("Racing {} configurations over {} rungs of {} trees on {} inner folds of {} outer tasks.".format(
+          len(configs), len(budgets), ",".join(str(i) for i in budgets), inner_folds, len(outer_tasks)))
+    wall_start = time.perf_counter()
+    search_df, winners = successive_halving(model, X, y, outer_tasks, configs, budgets, inner_folds, halving_factor, nproc, seed)
+    search_seconds = time.perf_counter() - wall_start
+    search_df.to_csv(search_values_file(output_values), sep = "\t", index = False)
+
+    chosen = {}
+    refit_tasks = []
+    for task in outer_tasks:
+        task_id = (task[1], task[2])
+        chosen[task_id] = dict(configs[winners[task_id]], n_estimators = chosen_n_estimators(search_df, task_id, winners[task_id], tolerance))
+        refit_tasks.append(task + (chosen[task_id],))
+    results = schedule_tasks(model, X, {None: (None, y)}, refit_tasks, nproc, run_cv_task)
+
+    rocauc_opt = open(output_values, "w")
+    rocauc_opt.write("\t".join(["repeat", "fold", "roc_auc", "n_estimators"] + SEARCH_PARAMS) + "\n")
+    for r, i, interp_tpr, roc_auc in results:
+        params = chosen[(r, i)]
+        rocauc_opt.write("\t".join([str(r), str(i), str(roc_auc), str(params['n_estimators'])] + [str(params[k]) for k in SEARCH_PARAMS]) + "\n")
+    rocauc_opt.close()
+
+    summary = search_df.assign(trees = search_df['n_estimators'] * inner_folds, selected = search_df['status'] == 'selected')
+    summary = summary.groupby(['config'] + SEARCH_PARAMS, sort = True).agg(
+              mean_rungs = ('rung', 'size'), trees = ('trees', 'sum'), wall_seconds = ('wall_seconds', 'sum'),
+              cpu_seconds = ('cpu_seconds', 'sum'), selected = ('selected', 'sum')).reset_index()
+    summary['mean_rungs'] /= len(outer_tasks)
+    summary.insert(3, 'first_rung_roc_auc', summary['config'].map(search_df[search_df['rung'] == 0].groupby('config')['inner_roc_auc'].mean()))
+    print(summary.drop(columns = 'config').to_string(index = False, float_format = lambda v: "{:.3f}".format(v)))
+    full_grid_trees = len(configs) * budgets[-1] * inner_folds * len(outer_tasks)
+    print("The search fitted {} trees ({:.0%} of a full grid at {} trees) in {:.1f} s wall-clock, {:.1f} s CPU summed over workers.".format(
+          summary['trees'].sum(), summary['trees'].sum() / full_grid_trees, budgets[-1], search_seconds, summary['cpu_seconds'].sum()))
+    aucs = np.array([result[3] for result in results])
+    print("Nested ROC-AUC {:.4f} +/- {:.4f} over {} outer tasks.".format(aucs.mean(), aucs.std(), len(aucs)))
+
+    plot_roc_curve(np.array([result[2] for result in results]), aucs, output_name)
+
+def plot_roc_curve(tprs, aucs, output_name, mean_fpr = np.linspace(0, 1, 100), null_p = None):
+    # tprs: a 2D array of interpolated TPRs, one row per (repeat, fold) task.
+    # aucs: the ROC-AUC of each task.
+    # output_name: specify the output figure name.
+    # null_p: the empirical P-value of the mean ROC-AUC against label-shuffled replicates, added to the legend if given.
+    # this function is to draw the single figure of the mean ROC curve with its standard deviation band.
+
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import auc
+
+    matplotlib.rcParams['font.family'] = 'sans-serif'
+    matplotlib.rcParams['font.sans-serif'] = 'Arial'
     fig, ax = plt.subplots()
     ax.plot([0, 1], [0, 1], linestyle="--", lw=2, color="r", label="Chance", alpha=0.8)
     mean_tpr = np.mean(tprs, axis=0)
     mean_tpr[-1] = 1.0
     mean_auc = auc(mean_fpr, mean_tpr)
     std_auc = np.std(aucs)
+    label = r"Mean ROC (AUC = %0.2f $\pm$ %0.2f)" % (mean_auc, std_auc)
+    if null_p is not None:
+        label = r"Mean ROC (AUC = %0.2f $\pm$ %0.2f, permutation P = %0.3g)" % (mean_auc, std_auc, null_p)
     ax.plot(
         mean_fpr,
         mean_tpr,
         color="b",
-        label=r"Mean ROC (AUC = %0.2f $\pm$ %0.2f)" % (mean_auc, std_auc),
+        label=label,
         lw=2,
         alpha=0.8,
     )
@@ -231,21 +1112,59 @@ def roc_auc_curve(model, X, y, fold, repeat, output_name, output_values):
     ax.set_xlabel('False Positive Rate')
     ax.set_ylabel('True Positive Rate')
     ax.legend(loc="lower right")
-    plt.savefig(output_name)
-    rocauc_opt.close()
+    fig.savefig(output_name)
+    plt.close(fig)
 
 
 
 if __name__ == "__main__":
 
     pars = read_args(sys.argv)
-    df = pd.read_csv(pars["mpa_df"], sep = "\t", index_col = False)
+    check_args(pars)
+    from sklearn.ensemble import RandomForestClassifier
     row_number_list = [int(i) for i in pars["md_rows"].split(",")]
-    pos_neg_dict = {pars["pos_feature"]:1, pars["neg_feature"]:0}
-    X, y = prepare_dataset(df, pos_neg_dict, row_number_list, pars["target_row"], pars["transform"])
     model = RandomForestClassifier(n_estimators = 1000,
                                    criterion = 'entropy',
                                    min_samples_leaf = 1,
-                                   max_features = 'sqrt',
-                                   n_jobs = 4) # initiating a RF classifier
-    roc_auc_curve(model, X, y, pars["fold_number"], pars["repeat_time"], pars["output"], pars["output_values"])
+                                   max_features = 'sqrt') # initiating a RF classifier, processors are assigned per task
+    if pars["manifest"]:
+        md_df, X, feature_names = prepare_matrix(pars["mpa_df"], row_number_list, pars["transform"], pars["clade_level"],
+                                                 feature_filter_params(pars))
+        contrasts = read_manifest(pars["manifest"], md_df)
+        roc_auc_batch(model, X, contrasts, pars["fold_number"], pars["repeat_time"], pars["output_values"],
+                      nproc = pars["nproc"], seed = pars["seed"], eval_mode = pars["eval_mode"],
+                      tree_step = pars["tree_step"], tolerance = pars["auc_tolerance"])
+    elif pars["eval_mode"] == 'nested':
+        pos_neg_dict = {pars["pos_feature"]:1, pars["neg_feature"]:0}
+        X, y, feature_names = prepare_dataset(pars["mpa_df"], pos_neg_dict, row_number_list, pars["target_row"], pars["transform"],
+                                              pars["clade_level"], feature_filter_params(pars))
+        configs = search_space(parse_search_values(pars["search_max_features"]), parse_search_values(pars["search_min_samples_leaf"]))
+        roc_auc_nested(model, X, y, pars["fold_number"], pars["repeat_time"], pars["output"], pars["output_values"],
+                       nproc = pars["nproc"], seed = pars["seed"], configs = configs,
+                       budgets = [int(i) for i in pars["search_n_estimators"].split(",")], inner_folds = pars["inner_folds"],
+                       halving_factor = pars["halving_factor"], tolerance = pars["auc_tolerance"])
+    else:
+        pos_neg_dict = {pars["pos_feature"]:1, pars["neg_feature"]:0}
+        run_params = {i: pars[i] for i in ["mpa_df", "md_rows", "target_row", "pos_feature", "neg_feature", "transform", "clade_level",
+                                           "fold_number", "repeat_time", "seed", "eval_mode"]}
+        if pars["eval_mode"] == 'warm_start':
+            run_params.update({i: pars[i] for i in ["tree_step", "auc_tolerance"]})
+        run_params["mpa_df"] = os.path.abspath(pars["mpa_df"])
+        run_params["model"] = {i: str(v) for i, v in model.get_params().items()}
+        run_params["importance"] = pars["permutation_repeats"] if pars["importance_output"] else None
+        if feature_filter_params(pars):
+            run_params["feature_filter"] = feature_filter_params(pars)
+        completed = read_checkpoint(checkpoint_file(pars["output_values"]), run_params) if pars["resume"] else {}
+        if len(completed) == len(task_ids(pars["eval_mode"], pars["fold_number"], pars["repeat_time"])) and not pars["null_replicates"] \
+           and not pars["importance_output"]:
+            print("All tasks are completed in the checkpoint, the figure is rebuilt without refitting.")
+            X, y, feature_names = None, None, None
+        else:
+            X, y, feature_names = prepare_dataset(pars["mpa_df"], pos_neg_dict, row_number_list, pars["target_row"], pars["transform"],
+                                                  pars["clade_level"], feature_filter_params(pars))
+        roc_auc_curve(model, X, y, pars["fold_number"], pars["repeat_time"], pars["output"], pars["output_values"],
+                      nproc = pars["nproc"], seed = pars["seed"], eval_mode = pars["eval_mode"],
+                      tree_step = pars["tree_step"], tolerance = pars["auc_tolerance"],
+                      null_replicates = pars["null_replicates"], null_trees = pars["null_trees"],
+                      run_params = run_params, completed = completed, importance_output = pars["importance_output"],
+                      permutation_repeats = pars["permutation_repeats"], features = feature_names)
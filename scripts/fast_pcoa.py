@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+NAME: fast_pcoa.py
+DESCRIPTION: fast_pcoa.py is a python module for approximate principal coordinate analysis on large cohorts, computing
+             only the leading axes. The <fsvd> method is a randomized eigensolver working on the distance matrix with
+             implicit double centering, so the centered n x n matrix is never built. The <landmark> method (landmark MDS)
+             needs distances to a subset of landmark samples only, so the full distance matrix is never built either.
+             As in skbio's default PCoA, <landmark> proportions explained are relative to the sum of positive eigenvalues
+             (of the landmark configuration). <fsvd> never sees the full spectrum, so as skbio's own fsvd method it uses the
+             trace of the centered matrix, i.e. the sum of all eigenvalues, negative ones included; with non-Euclidean
+             distances (e.g. braycurtis) its proportions are therefore larger than those of the default PCoA.
+DATE: 18.03.2024
+"""
+
+from scipy.spatial.distance import pdist, cdist, squareform
+import numpy as np
+
+def _squared_product(distances, Y, block_rows = 2048):
+    # distances: the n x n distance matrix.
+    # Y: a n x k matrix.
+    # this function is to compute (distances ** 2) @ Y in row blocks, so the squared matrix is never held in memory at once.
+
+    opt = np.empty((distances.shape[0], Y.shape[1]))
+    for start in range(0, distances.shape[0], block_rows):
+        opt[start: start + block_rows] = (distances[start: start + block_rows] ** 2) @ Y
+
+    return opt
+
+def _centered_product(distances, Y):
+    # this function is to compute B @ Y with B = -0.5 * J * D^2 * J the double-centered matrix and J the centering matrix.
+
+    Y = Y - Y.mean(axis = 0)
+    Z = _squared_product(distances, Y)
+    Z -= Z.mean(axis = 0)
+
+    return -0.5 * Z
+
+def _squared_trace(distances, block_rows = 2048):
+    # this function is to compute the trace of the double-centered matrix, equal to the sum of squared distances / (2n).
+    total = sum(float((distances[start: start + block_rows] ** 2).sum()) for start in range(0, distances.shape[0], block_rows))
+
+    return total / (2 * distances.shape[0])
+
+def fsvd_pcoa(distances, dimensions = 2, oversampling = 10, power_iterations = 4, seed = 0):
+    # distances: the n x n distance matrix, e.g. skbio DistanceMatrix.data.
+    # dimensions: the number of leading axes to compute.
+    # oversampling, power_iterations: the accuracy settings of the randomized range finder.
+    # seed: the seed of the random test matrix.
+    # this function is to compute the leading PCoA axes with a randomized eigensolver.
+    # It returns coordinates (n x dimensions), eigenvalues and proportions explained relative to the trace.
+
+    n = distances.shape[0]
+    rank = min(n, dimensions + oversampling)
+    rng = np.random.default_rng(seed)
+    Q, _ = np.linalg.qr(_centered_product(distances, rng.standard_normal((n, rank))))
+    for i in range(power_iterations):
+        Q, _ = np.linalg.qr(_centered_product(distances, Q))
+    T = Q.T @ _centered_product(distances, Q)
+    eigvals, eigvecs = np.linalg.eigh((T + T.T) / 2)
+    order = np.argsort(eigvals)[::-1][:dimensions]
+    eigvals = np.clip(eigvals[order], 0, None)
+    eigvecs = Q @ eigvecs[:, order]
+    coordinates = eigvecs * np.sqrt(eigvals)
+
+    return coordinates, eigvals, eigvals / _squared_trace(distances)
+
+def _pairwise(metric, X, Y = None, block_rows = 2048):
+    # this function is to compute distances among rows of X, or between rows of X and Y in row blocks.
+
+    if Y is None:
+        return squareform(pdist(X, metric))
+    opt = np.empty((X.shape[0], Y.shape[0]))
+    for start in range(0, X.shape[0], block_rows):
+        opt[start: start + block_rows] = cdist(X[start: start + block_rows], Y, metric)
+
+    return opt
+
+def landmark_pcoa(matrix, metric, landmarks = 1000, dimensions = 2, seed = 0):
+    # matrix: the samples x features abundance matrix.
+    # metric: the distance metric known to scipy, e.g. braycurtis or jaccard.
+    # landmarks: the number of randomly chosen landmark samples.
+    # dimensions: the number of leading axes to compute.
+    # seed: the seed for choosing landmarks.
+    # this function is to compute the leading PCoA axes by landmark MDS, triangulating every sample from its distances
+    # to the landmarks. Only landmarks x landmarks and samples x landmarks distances are computed.
+    # It returns coordinates (n x dimensions), eigenvalues and proportions explained of the landmark configuration.
+
+    n = matrix.shape[0]
+    landmarks = min(landmarks, n)
+    rng = np.random.default_rng(seed)
+    landmark_idx = np.sort(rng.choice(n, size = landmarks, replace = False))
+    landmark_matrix = matrix[landmark_idx]
+    landmark_squared = _pairwise(metric, landmark_matrix) ** 2
+    column_means = landmark_squared.mean(axis = 0)
+    B = -0.5 * (landmark_squared - column_means - column_means[:, np.newaxis] + column_means.mean())
+    eigvals, eigvecs = np.linalg.eigh(B)
+    positive_sum = eigvals[eigvals > 0].sum()
+    order = np.argsort(eigvals)[::-1][:dimensions]
+    eigvals = np.clip(eigvals[order], 0, None)
+    eigvecs = eigvecs[:, order]
+    pseudo_inverse = np.zeros_like(eigvecs)
+    positive = eigvals > 0
+    pseudo_inverse[:, positive] = eigvecs[:, positive] / np.sqrt(eigvals[positive])
+    sample_squared = _pairwise(metric, matrix, landmark_matrix) ** 2
+    coordinates = -0.5 * (sample_squared - column_means) @ pseudo_inverse
+
+    return coordinates, eigvals, eigvals / positive_sum
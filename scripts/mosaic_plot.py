@@ -9,37 +9,158 @@ AUTHOR: Kun D. Huang
 
 
 import pandas as pd
-from scipy.stats import fisher_exact
-import matplotlib.pyplot as plt
-from statsmodels.graphics.mosaicplot import mosaic
-import matplotlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import itertools
 import sys
+import os
 import argparse
 import textwrap
+from permutation_tests import permuted_labels, permutation_blocks, random_stream_key
 
+# scipy, statsmodels and matplotlib are loaded inside the functions needing them, which keeps --help fast.
 
+TEST_NAMES = {'fisher': "Fisher's exact test", 'chi2': "Chi-square test", 'permutation': "Monte-Carlo permutation test"}
+
+def contingency_codes(two_variable_df, variable1, variable2):
+    # this function is to convert two categorical columns into integer codes, dropping rows missing either value.
+    # Levels are sorted as in pd.crosstab.
+
+    sub_df = two_variable_df[[variable1, variable2]].dropna()
+    codes1, levels1 = pd.factorize(sub_df[variable1], sort = True)
+    codes2, levels2 = pd.factorize(sub_df[variable2], sort = True)
+
+    return codes1, codes2, list(levels1), list(levels2)
+
+def chi_square_statistics(tables, expected):
+    # tables: an array of contingency tables, the last two axes being rows and columns.
+    # expected: the table of expected counts under independence.
+    # this function is to compute the Pearson chi-square statistic of every table.
+    return (((tables - expected) ** 2) / expected).sum(axis = (-2, -1))
+
+def permutation_block(args):
+    # args: (codes of variable1, codes of variable2, table shape, expected counts, number of permutations, seed, stream key, block index).
+    # this function is to compute chi-square statistics of one block of permutations of variable2 against variable1.
+    # All tables of the block are counted with one bincount, each block has its own random stream.
+
+    codes1, codes2, shape, expected, permutations, seed, stream_key, block_index = args
+    permuted = permuted_labels(codes2, permutations, seed, stream_key, block_index)
+    cells = np.arange(permutations)[:, np.newaxis] * shape[0] * shape[1] + codes1 * shape[1] + permuted
+    tables = np.bincount(cells.ravel(), minlength = permutations * shape[0] * shape[1]).reshape(permutations, *shape)
+
+    return chi_square_statistics(tables, expected)
+
+def choose_method(table, method = 'auto', min_expected = 5):
+    # table: the observed contingency table.
+    # method: <auto>, <fisher>, <chi2> or <permutation>.
+    # this function is to resolve the test to run. <auto> runs Fisher's exact test on 2x2 tables, the chi-square test
+    # on larger tables whose expected counts are all >= min_expected, and the Monte-Carlo permutation test otherwise.
+
+    from scipy.stats.contingency import expected_freq
+
+    if method not in ['auto', 'fisher', 'chi2', 'permutation']:
+        sys.exit("Please choose test method from <auto>/<fisher>/<chi2>/<permutation>")
+    if method == 'fisher' and table.shape != (2, 2):
+        sys.exit("Fisher's exact test needs a 2x2 table, please choose <chi2> or <permutation> for larger tables")
+    if method != 'auto':
+        return method
+    if table.shape == (2, 2):
+        return 'fisher'
+    if expected_freq(table).min() >= min_expected:
+        return 'chi2'
+
+    return 'permutation'
+
+def contingency_tests(two_variable_df, pairs, method = 'auto', permutations = 9999, nproc = 1, seed = 0,
+                      min_expected = 5, block_elements = 2 ** 22, skip_degenerate = False):
+    # two_variable_df: a dataframe holding categorical columns.
+    # pairs: a list of (variable1, variable2) column pairs to test.
+    # method: the test method, see choose_method.
+    # permutations: the number of permutations of the Monte-Carlo permutation test.
+    # nproc: the number of processes running permutation blocks of all pairs.
+    # seed: the seed of permutations, the same seed gives the same p-values regardless of nproc.
+    # block_elements: the approximate number of (permutation x subject) cells handled at once.
+    # skip_degenerate: whether a pair in which a variable has fewer than two levels is reported as <skipped> with NA values,
+    #                  as in batch mode, instead of stopping the run.
+    # this function is to test independence of every pair in one process, sharing one pool for all permutation blocks,
+    # and return a dataframe with one row per pair.
+
+    from scipy.stats import fisher_exact, chi2_contingency
+    from scipy.stats.contingency import expected_freq
+    from statsmodels.stats.multitest import multipletests
+
+    observed = []
+    tasks = []
+    for pair_index, (variable1, variable2) in enumerate(pairs):
+        codes1, codes2, levels1, levels2 = contingency_codes(two_variable_df, variable1, variable2)
+        table = np.zeros((len(levels1), len(levels2)), dtype = np.int64)
+        np.add.at(table, (codes1, codes2), 1)
+        if min(table.shape) < 2:
+            if not skip_degenerate:
+                sys.exit("Variables {} and {} need at least two levels each".format(variable1, variable2))
+            observed.append([variable1, variable2, len(levels1), len(levels2), len(codes1), 'skipped', np.nan, np.nan])
+            continue
+        pair_method = choose_method(table, method, min_expected)
+        if pair_method == 'fisher':
+            statistic, p_value = fisher_exact(table, alternative = "two-sided")
+        elif pair_method == 'chi2':
+            statistic, p_value = chi2_contingency(table, correction = False)[:2]
+        else:
+            expected = expected_freq(table)
+            statistic, p_value = chi_square_statistics(table, expected), None
+            stream_key = random_stream_key(variable1, variable2)
+            for block_index, block_permutations in permutation_blocks(permutations, max(1, block_elements // len(codes1))):
+                tasks.append((pair_index, (codes1, codes2, table.shape, expected, block_permutations, seed, stream_key, block_index)))
+        observed.append([variable1, variable2, len(levels1), len(levels2), len(codes1), pair_method, statistic, p_value])
+
+    if nproc > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers = nproc) as pool:
+            block_opts = list(pool.map(permutation_block, [i[1] for i in tasks]))
+    else:
+        block_opts = [permutation_block(i[1]) for i in tasks]
+    for pair_index, results in enumerate(observed):
+        if results[-1] is None:
+            permuted = np.concatenate([block_opts[i] for i, task in enumerate(tasks) if task[0] == pair_index])
+            results[-1] = (np.count_nonzero(permuted >= results[-2] - 1e-9) + 1) / (permutations + 1)
+
+    tests_df = pd.DataFrame(observed, columns = ['variable1', 'variable2', 'levels1', 'levels2', 'sample_size', 'test', 'statistic', 'p-value'])
+    tested = tests_df['p-value'].notna() # skipped pairs are left out of the multiple testing correction
+    tests_df['adjusted_p-value'] = np.nan
+    if tested.any():
+        tests_df.loc[tested, 'adjusted_p-value'] = multipletests(tests_df.loc[tested, 'p-value'], method = 'fdr_bh')[1]
+
+    return tests_df
+
+def make_mosaic_plot(two_variable_file, facecolor_dict, output_fig, font_style = "sans-serif,Arial",
+                     method = 'auto', permutations = 9999, nproc = 1, seed = 0):
+    # method, permutations, nproc, seed: the test of independence, see contingency_tests.
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from statsmodels.graphics.mosaicplot import mosaic
 
-def make_mosaic_plot(two_variable_file, facecolor_dict, output_fig, font_style = "sans-serif,Arial"):
     font_family, font_type = font_style.split(",")
     matplotlib.rcParams['font.family'] = font_family
     matplotlib.rcParams['font.sans-serif'] = font_type
     two_variable_df = pd.read_csv(two_variable_file, sep = "\t", index_col = False)
-    features, variable1, variable2 = two_variable_df.columns
+    features, variable1, variable2 = two_variable_df.columns[:3]
     cont_df = pd.crosstab(two_variable_df[variable1], two_variable_df[variable2])
-    res = fisher_exact(cont_df, alternative = "two-sided")
+    res = contingency_tests(two_variable_df, [(variable1, variable2)], method, permutations, nproc, seed).iloc[0]
     label_dict = {}
     for idx in cont_df.index.to_list():
         for col in cont_df.columns.to_list():
             label_dict[(idx, col)]  = cont_df.loc[idx, col]
-    labelizer = lambda k:label_dict[k]
+    labelizer = lambda k:label_dict.get(k, 0)
     
-    variable2_0, variable2_1 = sorted(set(two_variable_df[variable2].to_list()))
     props = {}
     for variable in facecolor_dict:
-        props[(variable, variable2_0)] = {"facecolor": facecolor_dict[variable], "edgecolor": "white"}
-        props[(variable, variable2_1)] = {"facecolor": facecolor_dict[variable], "edgecolor": "white"}
-    mosaic(two_variable_df, [variable1, variable2], labelizer = labelizer, properties = props, title = " P-value: "+ str(res[1]) + " (Fisher's exact test)")
+        for level in cont_df.columns.to_list():
+            props[(variable, level)] = {"facecolor": facecolor_dict[variable], "edgecolor": "white"}
+    test_name = TEST_NAMES[res['test']]
+    if res['test'] == 'permutation':
+        test_name += ", {} permutations".format(permutations)
+    mosaic(two_variable_df, [variable1, variable2], labelizer = labelizer, properties = props, title = " P-value: "+ str(res['p-value']) + " (" + test_name + ")")
     plt.savefig(output_fig)
+    plt.close()
 
 if __name__ == "__main__":
     def read_args(args):
@@ -74,9 +195,69 @@ if __name__ == "__main__":
                             type = str,
                             default = None)
 
+        parser.add_argument('--test_method',
+                            nargs = '?',
+                            help = 'Specify the test of independence, <auto>/<fisher>/<chi2>/<permutation>. <auto> runs Fisher\'s exact test on 2x2 tables, \
+                                    the chi-square test on larger tables whose expected counts are all >= 5 and the Monte-Carlo permutation test otherwise. default: [auto]',
+                            type = str,
+                            default = 'auto')
+
+        parser.add_argument('--permutations',
+                            nargs = '?',
+                            help = 'Specify the number of permutations of the Monte-Carlo permutation test. default: [9999]',
+                            type = int,
+                            default = 9999)
+
+        parser.add_argument('--nproc',
+                            nargs = '?',
+                            help = 'Specify the number of processes running permutations. default: [1]',
+                            type = int,
+                            default = 1)
+
+        parser.add_argument('--seed',
+                            nargs = '?',
+                            help = 'Specify the random seed of permutations. default: [0]',
+                            type = int,
+                            default = 0)
+
+        parser.add_argument('--batch_output',
+                            nargs = '?',
+                            help = 'Specify a tab-delimited output file to test many pairs of columns of the input in one run instead of drawing a plot.',
+                            type = str,
+                            default = None)
+
+        parser.add_argument('--pairs',
+                            nargs = '?',
+                            help = 'Specify the pairs of columns tested in batch mode, e.g. <var1:var2,var1:var3>. default: [all pairs of columns after the first]',
+                            type = str,
+                            default = None)
+
         return vars(parser.parse_args())
         
     pars = read_args(sys.argv)
-    facecolor_dict = {i.rstrip().split("\t")[0]: i.rstrip().split("\t")[1] for i in open(pars['facecolor_map']).readlines()}
-    make_mosaic_plot(pars["input"], facecolor_dict , pars["output"], font_style = pars["font_style"])
+    if not pars["input"] or not os.path.isfile(pars["input"]):
+        sys.exit("Please input an existing table with --input!")
+    if pars["test_method"] not in ['auto', 'fisher', 'chi2', 'permutation']:
+        sys.exit("Please choose test method from <auto>/<fisher>/<chi2>/<permutation>")
+    if not pars["batch_output"] and (not pars["output"] or not os.path.isfile(pars["facecolor_map"])):
+        sys.exit("Please specify the output figure with --output and an existing face color map with --facecolor_map!")
+    if pars["batch_output"]:
+        two_variable_df = pd.read_csv(pars["input"], sep = "\t", index_col = False)
+        if pars["pairs"]:
+            pairs = [tuple(i.split(":")) for i in pars["pairs"].split(",")]
+        else:
+            pairs = list(itertools.combinations(two_variable_df.columns[1:], 2))
+        missing = [i for pair in pairs for i in pair if i not in two_variable_df.columns]
+        if missing:
+            sys.exit("Column(s) {} are not found in {}".format(",".join(missing), pars["input"]))
+        tests_df = contingency_tests(two_variable_df, pairs, pars["test_method"], pars["permutations"], pars["nproc"], pars["seed"],
+                                     skip_degenerate = True)
+        tests_df.to_csv(pars["batch_output"], sep = "\t", index = False, na_rep = 'NA')
+        skipped = tests_df[tests_df['test'] == 'skipped']
+        for _, row in skipped.iterrows():
+            print("Pair {} and {} is skipped, a variable has fewer than two levels".format(row['variable1'], row['variable2']))
+    else:
+        facecolor_dict = {i.rstrip().split("\t")[0]: i.rstrip().split("\t")[1] for i in open(pars['facecolor_map']).readlines()}
+        make_mosaic_plot(pars["input"], facecolor_dict , pars["output"], font_style = pars["font_style"],
+                         method = pars["test_method"], permutations = pars["permutations"], nproc = pars["nproc"], seed = pars["seed"])
 
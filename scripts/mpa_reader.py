@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+NAME: mpa_reader.py
+DESCRIPTION: mpa_reader.py is a python module to read MetaPhlAn-style merged tables (plain, .bz2 or .gz) in which
+             metadata rows may be wedged among abundance rows. The table is streamed line by line: metadata rows are
+             kept as text, abundance rows are filtered to a requested clade level or species subset on the fly and
+             parsed into a typed numeric matrix, so memory scales with the selected features only.
+             Tables can also be converted once into a binary store (a directory holding the samples x features matrix as
+             .npy plus text indexes), which read_mpa_table accepts in place of the table and opens memory-mapped.
+             Rare, low-abundance or low-variance features can be dropped right after loading with filter_features.
+DATE: 02.04.2024
+"""
+
+from collections import namedtuple
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import bz2
+import gzip
+
+MpaTable = namedtuple('MpaTable', ['samples', 'features', 'matrix', 'metadata', 'metadata_rows', 'header'])
+# samples: a list of sample names.
+# features: a list of names of the selected abundance rows.
+# matrix: the samples x features numeric matrix.
+# metadata: a dataframe of metadata rows, indexed by sample names with one column per metadata row.
+# metadata_rows: the row numbers of metadata rows (zero-based without considering header row), in column order.
+# header: the name of the first column of the table, e.g. sample or clade_name.
+
+CLADE_LEVELS = ['k', 'p', 'c', 'o', 'f', 'g', 's', 't']
+
+STORE_INFO = 'mpa_store.json' # the file marking a directory as a binary store
+
+def open_table(table_file):
+    # this function is to open a plain, bzip2 or gzip compressed text file for reading, judged by its extension.
+
+    if table_file.endswith('.bz2'):
+        return bz2.open(table_file, 'rt')
+    elif table_file.endswith('.gz'):
+        return gzip.open(table_file, 'rt')
+    else:
+        return open(table_file, 'r')
+
+def clade_selector(clade_level = None, species = None):
+    # clade_level: a MetaPhlAn rank letter (k/p/c/o/f/g/s/t), keeping rows whose last rank is at this level.
+    # species: a collection of names, keeping rows whose full name or any rank of it is among them.
+    # this function is to build the predicate deciding which abundance rows are kept.
+
+    if clade_level is not None and clade_level not in CLADE_LEVELS:
+        raise ValueError("Unsupported clade level {}. Please choose from {}.".format(clade_level, "/".join(CLADE_LEVELS)))
+    species = set(species) if species is not None else None
+
+    def select(name):
+        ranks = name.split('|')
+        if clade_level is not None and not ranks[-1].startswith(clade_level + '__'):
+            return False
+        if species is not None and name not in species and not species.intersection(ranks):
+            return False
+        return True
+
+    return select
+
+def read_mpa_table(table_file, md_rows = None, md_names = None, clade_level = None, species = None, dtype = np.float32,
+                   detect_metadata = None):
+    # table_file: the path to the merged table, plain or compressed by bzip2/gzip.
+    # md_rows: row numbers of metadata rows, zero-based without considering header row.
+    # md_names: names (first column) of metadata rows.
+    # clade_level, species: the filters applied on abundance rows, see clade_selector.
+    # dtype: the numeric type of the abundance matrix.
+    # detect_metadata: whether rows with any non-numeric value are also taken as metadata, by default only if neither
+    #                  md_rows nor md_names is given.
+    # this function is to stream the table and return a MpaTable. Rows listed in md_rows or md_names are metadata,
+    # even if their values are numbers (e.g. a 0/1 coded status).
+
+    if is_mpa_store(table_file):
+        return load_mpa_store(table_file, md_rows, md_names, clade_level, species, dtype)
+
+    auto_detect = md_rows is None and md_names is None if detect_metadata is None else detect_metadata
+    md_rows = set(md_rows or [])
+    md_names = set(md_names or [])
+    select = clade_selector(clade_level, species)
+
+    features = []
+    rows = []
+    md_values = []
+    md_columns = []
+    metadata_rows = []
+    with open_table(table_file) as table:
+        header = table.readline().rstrip('\n').split('\t')
+        for row_number, line in enumerate(table):
+            name, values = line.rstrip('\n').split('\t', 1)
+            values = values.split('\t')
+            is_metadata = row_number in md_rows or name in md_names
+            selected = select(name)
+            if not is_metadata and not selected and not auto_detect:
+                continue
+            if not is_metadata:
+                try:
+                    values = np.array(values, dtype = dtype) # parsed but not kept if unselected, to tell metadata rows apart
+                except ValueError:
+                    if not auto_detect:
+                        raise ValueError("Row {} ({}) of {} is not numeric, is it a metadata row?".format(row_number, name, table_file))
+                    is_metadata = True
+                if not is_metadata and not selected:
+                    continue
+            if is_metadata:
+                md_columns.append(name)
+                md_values.append(values)
+                metadata_rows.append(row_number)
+            else:
+                features.append(name)
+                rows.append(values)
+
+    samples = header[1:]
+    if rows:
+        matrix = np.vstack(rows).T
+    else:
+        matrix = np.empty((len(samples), 0), dtype = dtype)
+    metadata = pd.DataFrame(dict(zip(md_columns, md_values)), index = pd.Index(samples, name = header[0]), dtype = object)
+
+    return MpaTable(samples, features, matrix, metadata, metadata_rows, header[0])
+
+def is_mpa_store(path):
+    # this function is to tell whether a path is a binary store written by write_mpa_store.
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, STORE_INFO))
+
+def store_checksum(store_dir):
+    # this function is to return the content hash of a binary store recorded at conversion, used as its cache identity.
+    return json.load(open(os.path.join(store_dir, STORE_INFO)))['checksum']
+
+def write_mpa_store(table, store_dir, extra_metadata = None):
+    # table: a MpaTable, e.g. from read_mpa_table.
+    # store_dir: the directory to create, replaced if it exists.
+    # extra_metadata: an optional dataframe indexed by sample names whose columns are added to the metadata.
+    # this function is to write a table as a binary store: matrix.npy (samples x features, one contiguous row per sample),
+    # samples.txt, features.txt, metadata.tsv and mpa_store.json. Files are written into a temporary directory first,
+    # so an interrupted conversion never leaves a half-written store.
+
+    metadata = table.metadata
+    if extra_metadata is not None:
+        extra_metadata = extra_metadata.reindex(table.samples)
+        extra_metadata.index = metadata.index
+        metadata = pd.concat([metadata, extra_metadata.drop(columns = [i for i in extra_metadata.columns if i in metadata.columns])], axis = 1)
+    parent = os.path.dirname(os.path.abspath(store_dir))
+    tmp_dir = tempfile.mkdtemp(dir = parent, suffix = '.tmp')
+    np.save(os.path.join(tmp_dir, 'matrix.npy'), np.ascontiguousarray(table.matrix))
+    with open(os.path.join(tmp_dir, 'samples.txt'), 'w') as opt:
+        opt.write("".join(i + "\n" for i in table.samples))
+    with open(os.path.join(tmp_dir, 'features.txt'), 'w') as opt:
+        opt.write("".join(i + "\n" for i in table.features))
+    metadata.to_csv(os.path.join(tmp_dir, 'metadata.tsv'), sep = '\t')
+
+    digest = hashlib.sha256()
+    for name in ['matrix.npy', 'samples.txt', 'features.txt', 'metadata.tsv']:
+        with open(os.path.join(tmp_dir, name), 'rb') as store_file:
+            for chunk in iter(lambda: store_file.read(1 << 20), b''):
+                digest.update(chunk)
+    info = {'header': table.header,
+            'metadata_rows': [int(i) for i in table.metadata_rows],
+            'dtype': str(table.matrix.dtype),
+            'shape': list(table.matrix.shape),
+            'checksum': digest.hexdigest()}
+    with open(os.path.join(tmp_dir, STORE_INFO), 'w') as opt:
+        json.dump(info, opt, indent = 1)
+    os.chmod(tmp_dir, 0o755)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+
+def load_mpa_store(store_dir, md_rows = None, md_names = None, clade_level = None, species = None, dtype = np.float32):
+    # store_dir: a binary store written by write_mpa_store.
+    # md_rows, md_names: metadata rows expected by the caller, they must have been stored as metadata.
+    # clade_level, species, dtype: as in read_mpa_table.
+    # this function is to open a binary store as a MpaTable. The matrix is memory-mapped read-only, so only the parts
+    # which are used are read from disk; it is copied only if features are filtered out or another dtype is asked for.
+
+    info = json.load(open(os.path.join(store_dir, STORE_INFO)))
+    samples = [i.rstrip('\n') for i in open(os.path.join(store_dir, 'samples.txt')).readlines()]
+    features = [i.rstrip('\n') for i in open(os.path.join(store_dir, 'features.txt')).readlines()]
+    metadata = pd.read_csv(os.path.join(store_dir, 'metadata.tsv'), sep = '\t', index_col = 0, dtype = str, keep_default_na = False)
+    metadata.index = pd.Index(samples, name = info['header'])
+    missing = [str(i) for i in (md_rows or []) if i not in info['metadata_rows']]
+    missing += [i for i in (md_names or []) if i not in metadata.columns]
+    if missing:
+        raise ValueError("Metadata row(s) {} are not stored as metadata in {}, please convert the table again.".format(",".join(missing), store_dir))
+
+    matrix = np.load(os.path.join(store_dir, 'matrix.npy'), mmap_mode = 'r')
+    if clade_level is not None or species is not None:
+        select = clade_selector(clade_level, species)
+        kept = [i for i, name in enumerate(features) if select(name)]
+        if len(kept) < len(features):
+            matrix = matrix[:, kept]
+            features = [features[i] for i in kept]
+    if matrix.dtype != dtype:
+        matrix = matrix.astype(dtype)
+
+    return MpaTable(samples, features, matrix, metadata, info['metadata_rows'], info['header'])
+
+FILTER_PARAMS = ['min_prevalence', 'min_mean_abundance', 'min_max_abundance', 'top_variance']
+
+def select_features(matrix, min_prevalence = None, min_mean_abundance = None, min_max_abundance = None, top_variance = None):
+    # matrix: the samples x features abundance matrix.
+    # min_prevalence: the minimum fraction of samples in which a feature is present (abundance > 0).
+    # min_mean_abundance, min_max_abundance: the minimum mean and maximum abundance of a feature across samples.
+    # top_variance: the number of features with the highest variance kept among those passing the other filters.
+    # this function is to return the indices of kept features, in their original order, and a report of how many
+    # features each filter dropped. Filters left as None are not applied.
+
+    n_samples, n_features = matrix.shape
+    keep = np.ones(n_features, dtype = bool)
+    dropped = {}
+    for name, threshold, statistic in [('min_prevalence', min_prevalence, lambda m: np.count_nonzero(m, axis = 0) / max(n_samples, 1)),
+                                       ('min_mean_abundance', min_mean_abundance, lambda m: m.mean(axis = 0, dtype = np.float64)),
+                                       ('min_max_abundance', min_max_abundance, lambda m: m.max(axis = 0, initial = 0))]:
+        if threshold is not None:
+            passed = statistic(matrix) >= threshold
+            dropped[name] = int(np.count_nonzero(keep & ~passed))
+            keep &= passed
+    kept = np.flatnonzero(keep)
+    if top_variance is not None:
+        variances = matrix[:, kept].var(axis = 0, dtype = np.float64)
+        top = np.sort(np.argsort(-variances, kind = 'stable')[:top_variance])
+        dropped['top_variance'] = len(kept) - len(top)
+        kept = kept[top]
+    report = {'features': n_features, 'kept': len(kept), 'dropped': dropped}
+
+    return kept, report
+
+def filter_features(table, min_prevalence = None, min_mean_abundance = None, min_max_abundance = None, top_variance = None):
+    # table: a MpaTable, e.g. from read_mpa_table.
+    # min_prevalence, min_mean_abundance, min_max_abundance, top_variance: the filters, see select_features.
+    # this function is to drop rare, low-abundance or low-variance features at load time, and return the filtered
+    # MpaTable with the filter report. The table is returned unchanged if no filter is given or none drops anything.
+
+    start = time.perf_counter()
+    kept, report = select_features(table.matrix, min_prevalence, min_mean_abundance, min_max_abundance, top_variance)
+    if len(kept) < len(table.features):
+        table = table._replace(features = [table.features[i] for i in kept], matrix = table.matrix[:, kept])
+    report['seconds'] = time.perf_counter() - start
+
+    return table, report
+
+def filter_report(report, n_samples):
+    # report: a report from select_features or filter_features.
+    # n_samples: the number of samples, for counting matrix cells.
+    # this function is to describe a filter report in one line, with the shrink of the matrix handed to later steps.
+
+    dropped = ", ".join("{} by {}".format(v, k) for k, v in report['dropped'].items())
+    shrink = report['features'] / max(report['kept'], 1)
+
+    return "Feature filter kept {} of {} features ({} dropped: {}) in {:.2f} s; the matrix shrinks from {} to {} cells ({:.1f}-fold).".format(
+           report['kept'], report['features'], report['features'] - report['kept'], dropped or "none", report.get('seconds', 0),
+           n_samples * report['features'], n_samples * report['kept'], shrink)
+
+def filter_error(feature_filter):
+    # feature_filter: a dictionary of filters named in FILTER_PARAMS.
+    # this function is to return a message if a filter is out of range, or None if all of them are valid.
+
+    if not 0 <= feature_filter.get('min_prevalence', 0) <= 1:
+        return "Please give --min_prevalence as a fraction of samples between 0 and 1"
+    if feature_filter.get('min_mean_abundance', 0) < 0 or feature_filter.get('min_max_abundance', 0) < 0:
+        return "Please give a non-negative --min_mean_abundance and --min_max_abundance"
+    if feature_filter.get('top_variance', 1) < 1:
+        return "Please give a positive --top_variance"
+
+    return None
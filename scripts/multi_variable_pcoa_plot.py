@@ -9,21 +9,19 @@ DATE: 31.10.2023
 Author: Kun D. Huang
 """
 
-from skbio.diversity import beta_diversity
-from skbio.stats.ordination import pcoa
-from skbio.stats.distance import DistanceMatrix
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-import seaborn as sns
 import sys
+import os
 import argparse
 import math
-from skbio.stats.distance import anosim
+from mpa_reader import read_mpa_table, is_mpa_store, select_features, filter_features, filter_report, filter_error, FILTER_PARAMS
 import textwrap
 from collections import namedtuple
 
+# scikit-bio, scipy, matplotlib, seaborn and the distance/PCoA/test modules are imported by the methods using them,
+# so that --help and argument errors do not wait for them, and only the modules needed by the chosen options are loaded.
+
 def read_args(args):
     # This function is to parse arguments
 
@@ -38,13 +36,13 @@ def read_args(args):
 
     parser.add_argument('--abundance_table',
                         nargs = '?',
-                        help = 'Input the merged abundance table generated by MetaPhlAn.',
+                        help = 'Input the merged abundance table generated by MetaPhlAn, plain, compressed (.bz2/.gz) or converted by convert_mpa_table.py.',
                         type = str,
                         default = None)
 
     parser.add_argument('--metadata',
                         nargs = '?',
-                        help = 'Input a tab-delimited metadata file.',
+                        help = 'Input a tab-delimited metadata file, or a store converted by convert_mpa_table.py with --metadata.',
                         type = str,
                         default = None)
 
@@ -121,10 +119,40 @@ def read_args(args):
 
     parser.add_argument('--test',
                         nargs = '?',
-                        help = 'Specify an output file for saving permanova test results. For example, project_name_stats.tsv',
+                        help = 'Specify an output file for saving permanova/anosim test results. For example, project_name_stats.tsv',
                         type = str,
                         default = None)
 
+    parser.add_argument('--test_methods',
+                        nargs = '?',
+                        help = 'Specify the permutation tests to run with --test, comma delimited. <permanova>/<anosim>. default: [permanova,anosim]',
+                        type = str,
+                        default = 'permanova,anosim')
+
+    parser.add_argument('--test_variables',
+                        nargs = '?',
+                        help = 'Specify the metadata columns to test with --test, comma delimited. default: [None] (variables given by --variable1/2/3)',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--permutations',
+                        nargs = '?',
+                        help = 'Specify the number of permutations for each test. default: [999]',
+                        type = int,
+                        default = 999)
+
+    parser.add_argument('--seed',
+                        nargs = '?',
+                        help = 'Specify the random seed for permutations, the same seed gives the same p-values with any --nproc. default: [0]',
+                        type = int,
+                        default = 0)
+
+    parser.add_argument('--nproc',
+                        nargs = '?',
+                        help = 'Specify the number of processors used for computing distances and permutation tests. default: [1]',
+                        type = int,
+                        default = 1)
+
 
     parser.add_argument('--df_opt',
                         nargs = '?',
@@ -132,6 +160,87 @@ def read_args(args):
                         type = str,
                         default = None)
 
+    parser.add_argument('--distance_engine',
+                        nargs = '?',
+                        help = 'Specify the engine computing distances. <skbio>: skbio beta_diversity; <builtin>: chunked computation across --nproc threads, \
+                                available for <braycurtis>/<jaccard>, faster on large tables but distances may differ from skbio in the last digits \
+                                (about 1e-14), other metrics use skbio anyway. default: [skbio]',
+                        type = str,
+                        default = 'skbio')
+
+    parser.add_argument('--dtype',
+                        nargs = '?',
+                        help = 'Specify the floating point precision of the abundance matrix, <float64>/<float32>. <float32> halves memory of the matrix. default: [float64]',
+                        type = str,
+                        default = 'float64')
+
+    parser.add_argument('--clade_level',
+                        nargs = '?',
+                        help = 'Specify a MetaPhlAn rank letter, e.g. <s> or <t>, to compute distances on clades at that level only. \
+                                Metadata rows wedged in the table are skipped. default: [all rows]',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--min_prevalence',
+                        nargs = '?',
+                        help = 'Drop clades present (abundance > 0) in less than this fraction of samples, e.g. <0.1>, before distances are computed. \
+                                Feature filters are part of the cache key. default: [None]',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--min_mean_abundance',
+                        nargs = '?',
+                        help = 'Drop clades whose mean abundance across samples is below this value. default: [None]',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--min_max_abundance',
+                        nargs = '?',
+                        help = 'Drop clades whose maximum abundance across samples is below this value. default: [None]',
+                        type = float,
+                        default = None)
+
+    parser.add_argument('--top_variance',
+                        nargs = '?',
+                        help = 'Keep only this number of clades with the highest abundance variance among those passing the other filters. default: [None]',
+                        type = int,
+                        default = None)
+
+    parser.add_argument('--matrix_format',
+                        nargs = '?',
+                        help = 'Specify how the abundance matrix is held for the builtin engine, <dense>/<sparse>. <sparse> (CSR) is faster and smaller \
+                                when most species are absent from most samples, it brings nothing with --transformation log. default: [dense]',
+                        type = str,
+                        default = 'dense')
+
+    parser.add_argument('--pcoa_method',
+                        nargs = '?',
+                        help = 'Specify the PCoA method. <eigh>: full eigendecomposition; <fsvd>: randomized solver for the leading axes only; \
+                                <landmark>: landmark MDS from distances to --landmarks samples, the full distance matrix is not built unless --test is given. \
+                                With <landmark> PC1(%%)/PC2(%%) are relative to the sum of positive eigenvalues as with <eigh>, with <fsvd> to the trace \
+                                of the centered matrix, which includes negative eigenvalues and gives larger percentages for non-Euclidean metrics. default: [eigh]',
+                        type = str,
+                        default = 'eigh')
+
+    parser.add_argument('--landmarks',
+                        nargs = '?',
+                        help = 'Specify the number of landmark samples for --pcoa_method landmark. default: [1000]',
+                        type = int,
+                        default = 1000)
+
+    parser.add_argument('--cache_dir',
+                        nargs = '?',
+                        help = 'Specify a directory for caching distance matrices and PCoA results, keyed by the abundance table content, --metric, --transformation and --amplifier. \
+                                Re-plotting with other variables, palettes or fonts then skips the distance and PCoA computation. default: [None] (no caching)',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--cache_max_size',
+                        nargs = '?',
+                        help = 'Specify the maximum size of the cache directory in megabytes, least recently used entries are removed first. default: [1024]',
+                        type = int,
+                        default = 1024)
+
     parser.add_argument('--font_style',
                         nargs = '?',
                         help = 'Specify the font style which is composed by font family and font type, delimited with a comma. default: [sans-serif,Arial]',
@@ -146,18 +255,103 @@ def read_args(args):
 
     return vars(parser.parse_args())
 
+def clean_abundance_df(raw_df):
+    # raw_df: the merged metaphlan table read into a dataframe, 1st column contains clade names.
+    # this function is to remove zero-sum rows (clades) and zero-sum columns (samples) while keeping the clade column.
+
+    values = raw_df.iloc[:, 1:]
+    row_mask = values.sum(axis = 1) != 0
+    col_mask = [True] + (values.sum(axis = 0) != 0).to_list()
+
+    return raw_df.loc[row_mask, col_mask]
+
 class BetaDiversity:
 
     """
     This object is to deal with beta diversity analysis
     """
 
-    def __init__(self, matrix_value, metadata):
-        # matrix_value: the merged standard relative abundance table from metaphlan.
+    def __init__(self, matrix_value, metadata, cache = None, pcoa_method = 'eigh', landmarks = 1000, seed = 0,
+                 nproc = 1, distance_engine = 'skbio', dtype = 'float64', matrix_format = 'dense', clade_level = None,
+                 feature_filter = None):
+        # matrix_value: the merged standard relative abundance table from metaphlan, either a file path or an already loaded dataframe.
         # metadata: the tab-delimited metadata file, each column contains one metadata parameter.
-
+        # cache: a DistanceCache object for reusing distance matrices and PCoA results across runs, None for no caching.
+        # pcoa_method: <eigh> for full eigendecomposition, <fsvd> or <landmark> for approximating the leading axes, see fast_pcoa.py.
+        # landmarks: the number of landmark samples for the <landmark> method.
+        # seed: the seed of the randomized PCoA methods.
+        # nproc: the number of threads used by the builtin distance engine.
+        # distance_engine: <builtin> for the chunked engine in distance_engine.py (braycurtis/jaccard), <skbio> for skbio beta_diversity.
+        # dtype: <float64> or <float32>, the precision of the abundance matrix.
+        # matrix_format: <dense> or <sparse>, how the abundance matrix is handed to the builtin engine.
+        # clade_level: None for all abundance rows, or a rank letter (e.g. s or t) for keeping only clades at that level.
+        # feature_filter: a dictionary of filters dropping rare, low-abundance or low-variance clades at load time, see mpa_reader.py.
+
+        if pcoa_method not in ['eigh', 'fsvd', 'landmark']:
+            sys.exit("Please choose PCoA method from <eigh>/<fsvd>/<landmark>")
+        if distance_engine not in ['builtin', 'skbio']:
+            sys.exit("Please choose distance engine from <builtin>/<skbio>")
+        if dtype not in ['float64', 'float32']:
+            sys.exit("Please choose dtype from <float64>/<float32>")
+        if matrix_format not in ['dense', 'sparse']:
+            sys.exit("Please choose matrix format from <dense>/<sparse>")
+        if feature_filter and filter_error(feature_filter):
+            sys.exit(filter_error(feature_filter))
         self.abundance_table = matrix_value
         self.metadata = metadata
+        self.cache = cache
+        self.pcoa_method = pcoa_method
+        self.landmarks = landmarks
+        self.seed = seed
+        self.nproc = nproc
+        self.distance_engine = distance_engine
+        self.dtype = dtype
+        self.matrix_format = matrix_format
+        self.clade_level = clade_level
+        self.feature_filter = feature_filter or {}
+        self.distance_params = None # transformation, metric and amplifier defining distances between samples.
+        self._cache_key = None # the cache key of the distance matrix estimated by this object.
+        self._valid_samples = None # the samples of the estimated distance matrix, available without parsing the table on cache hits.
+        self._abundance_df = None # the cleaned abundance dataframe, parsed once and shared by all methods.
+        self._metadata_df = None # the full metadata dataframe, parsed once and shared by all methods.
+        self._metadata_index_col = None
+
+    def load_abundance_df(self):
+        # this function is to read the merged abundance table, apply the feature filters and clean it by removing zero-sum
+        # rows and columns. The table is parsed only once, later calls return the cached dataframe.
+
+        if self._abundance_df is None:
+            if isinstance(self.abundance_table, pd.DataFrame):
+                raw_df = self.abundance_table
+                if self.feature_filter:
+                    kept, report = select_features(raw_df.iloc[:, 1:].to_numpy().T, **self.feature_filter)
+                    raw_df = raw_df.iloc[kept]
+                    print(filter_report(report, raw_df.shape[1] - 1))
+            else:
+                # stream the merged metaphlan table, skipping wedged metadata rows and clades at other levels
+                table = read_mpa_table(self.abundance_table, clade_level = self.clade_level, dtype = self.dtype)
+                if self.feature_filter:
+                    table, report = filter_features(table, **self.feature_filter)
+                    print(filter_report(report, len(table.samples)))
+                raw_df = pd.DataFrame(table.matrix.T, columns = table.samples)
+                raw_df.insert(0, table.header, table.features)
+            self._abundance_df = clean_abundance_df(raw_df)
+
+        return self._abundance_df
+
+    def load_metadata_df(self, index_col):
+        # index_col: the column name for index column.
+        # this function is to read the metadata table once, later calls with the same index column return the cached dataframe.
+
+        if self._metadata_df is None or self._metadata_index_col != index_col:
+            if is_mpa_store(self.metadata):
+                self._metadata_df = read_mpa_table(self.metadata).metadata # metadata stored along with the abundance matrix
+                self._metadata_df.index.name = index_col
+            else:
+                self._metadata_df = pd.read_csv(self.metadata, sep = "\t", index_col = index_col)
+            self._metadata_index_col = index_col
+
+        return self._metadata_df
 
     def est_beta_diversity_matrix(self, trans_func, diversity_metric, amplifier):
         # trans_func: the function for transforming abundance values, e.g. sqrt or log.
@@ -165,29 +359,83 @@ class BetaDiversity:
         # amplifier: N times the relative abundnce values, e.g. 10000
         # this function is to estimate beta diversity by users' defined transformation function and metric.
 
-        raw_df = pd.read_csv(self.abundance_table, sep = "\t", index_col = False) # read merged metaphlan table into a dataframe
-        df = raw_df.loc[(raw_df.sum(axis=1) != 0), (raw_df.sum(axis=0) != 0)] # clean raw df by removing zero-sum rows and columns
+        self.define_distance(trans_func, diversity_metric, amplifier)
+        if self._cache_key:
+            data_matrix = self.cache.load_distance_matrix(self._cache_key)
+            if data_matrix is not None:
+                self._valid_samples = data_matrix.ids
+                return data_matrix
+
+        from skbio.stats.distance import DistanceMatrix
+        from distance_engine import condensed_distances, SUPPORTED_METRICS
+
+        ids, matrix = self.build_abundance_matrix(trans_func, amplifier)
+        if self.distance_engine == 'builtin' and diversity_metric in SUPPORTED_METRICS:
+            from scipy import sparse
+            from scipy.spatial.distance import squareform
+
+            if self.matrix_format == 'sparse':
+                matrix = sparse.csr_matrix(matrix)
+            condensed = condensed_distances(matrix, diversity_metric, nproc = self.nproc)
+            data_matrix = DistanceMatrix(squareform(condensed, checks = False), ids)
+        else:
+            from skbio.diversity import beta_diversity
+
+            data_matrix = beta_diversity(diversity_metric, matrix, ids)
+        self._valid_samples = data_matrix.ids
+        if self._cache_key:
+            self.cache.save_distance_matrix(self._cache_key, data_matrix)
+
+        return data_matrix
+
+    def define_distance(self, trans_func, diversity_metric, amplifier):
+        # this function is to record how distances are defined, which is all the <landmark> PCoA method needs
+        # without estimating the full beta diversity matrix.
+
+        self.distance_params = (trans_func, diversity_metric, amplifier)
+        if self.cache is not None and not isinstance(self.abundance_table, pd.DataFrame):
+            self._cache_key = self.cache.make_key(self.abundance_table,
+                                                  metric = diversity_metric,
+                                                  transformation = trans_func,
+                                                  amplifier = amplifier,
+                                                  dtype = self.dtype,
+                                                  distance_engine = self.distance_engine, # engines differ in the last digits
+                                                  clade_level = self.clade_level,
+                                                  **({'feature_filter': self.feature_filter} if self.feature_filter else {}))
+
+    def build_abundance_matrix(self, trans_func, amplifier):
+        # trans_func: the function for transforming abundance values, e.g. sqrt or log.
+        # amplifier: N times the relative abundnce values, e.g. 10000
+        # this function is to build the sample x species matrix in one go, transposing the cleaned table once
+        # and applying the amplifier and transformation on the whole array instead of value by value.
+
+        if trans_func not in [None, 'sqrt', 'log']:
+            sys.exit("Please choose transformation function from <sqrt>/<log>/<None>")
+
+        df = self.load_abundance_df() # the merged metaphlan table with zero-sum rows and columns removed
         ids = df.columns[1:] # get all sample names
-        matrix = [] # the matrix of rel abundance, each row contains all abundances for one sample
-        for s in ids:
-            bug_abundances_one_sample = []
-            for i in df.index:
-                abundance_value = df.loc[i, s]
-                if trans_func == None:
-                    bug_abundances_one_sample.append(float(abundance_value) * amplifier)
-                elif trans_func == 'sqrt':
-                    bug_abundances_one_sample.append(math.sqrt(float(abundance_value) * amplifier)) 
-                elif trans_func == 'log':
-                    bug_abundances_one_sample.append(math.log1p(float(abundance_value) * amplifier + 1)) 
-                else:
-                    sys.exit("Please choose transformation function from <sqrt>/<log>/<None>")
-            matrix.append(bug_abundances_one_sample)
+        matrix = df[ids].to_numpy(dtype = self.dtype).T # the matrix of rel abundance, each row contains all abundances for one sample
+        matrix = matrix * amplifier
+        if trans_func == 'sqrt':
+            np.sqrt(matrix, out = matrix)
+        elif trans_func == 'log':
+            # math.log1p keeps distances bit-identical to the value-by-value builder, numpy's SIMD log1p differs in the last
+            # bit for some values. It is evaluated once per distinct present value: absent species all map to log1p(1), so
+            # only the non-zero entries are sorted, not the whole matrix (see check_beta_matrix.py for the cost).
+            present = matrix != 0
+            unique_values, inverse = np.unique(matrix[present] + 1, return_inverse = True)
+            log_values = np.array([math.log1p(i) for i in unique_values])
+            matrix = np.full(matrix.shape, math.log1p(1.0))
+            matrix[present] = log_values[inverse.ravel()]
+            matrix = matrix.astype(self.dtype)
+
+        return ids, matrix
 
-        return beta_diversity(diversity_metric, matrix, ids)
     def get_valid_samples(self):
         # this function is to return a list of valid samples to match with metadata.
-        raw_df = pd.read_csv(self.abundance_table, sep = "\t", index_col = False)
-        df = raw_df.loc[(raw_df.sum(axis=1) != 0), (raw_df.sum(axis=0) != 0)]
+        if self._valid_samples is not None:
+            return self._valid_samples
+        df = self.load_abundance_df()
 
         return df.columns
 
@@ -197,11 +445,9 @@ class BetaDiversity:
         variables = [i for i in variables if i]
         variables = list(set(variables))
         if len(variables) > 0:
-            metadata_df = pd.read_csv(self.metadata, sep = "\t", index_col = index_col)[variables]
+            metadata_df = self.load_metadata_df(index_col)[variables]
             valid_samples = self.get_valid_samples() # get all samples which match with those in the metadata table.
-            metadata_index = metadata_df.index
-            rows_to_drop = [i for i in metadata_index if i not in valid_samples]
-            metadata_df = metadata_df.drop(rows_to_drop) # drop those rows in the metadata table where samples cannot be found in the abundance table
+            metadata_df = metadata_df[metadata_df.index.isin(valid_samples)] # drop those rows in the metadata table where samples cannot be found in the abundance table
             return metadata_df
         else:
             sys.exit("None of three variables were detected. Please specify at least one variable using --variable1, --variable2 or --variable3!")
@@ -214,9 +460,7 @@ class BetaDiversity:
         variables = [i for i in variables if i ]
         variables = list(set(variables))
         if len(variables) > 0:
-            PCoAs= pcoa(data_matrix)
-            coordinates= PCoAs.samples.loc[:, ["PC1", "PC2"]] # Take first two coordinates
-            PC_explained = PCoAs.proportion_explained
+            coordinates, PC_explained = self.ordinate(data_matrix)
             PC1_p = round(PC_explained['PC1']*100,2) #PC1 explained percentage
             PC2_p = round(PC_explained['PC2']*100,2) #PC2 explained percentage
             metadata_df = self.get_valid_metadata(index_col, variables)
@@ -225,19 +469,77 @@ class BetaDiversity:
             sys.exit("None of three variables were detected. Please specify at least one variable using --variable1, --variable2 or --variable3!")
             
 
-    def permanova_test(self, data_matrix, index_col, variable):
+    def ordinate(self, data_matrix, axes = 10):
+        # data_matrix: the skbio style matrix fed into PCoA analysis, can be None for the <landmark> method.
+        # axes: the number of leading axes computed by approximate methods or kept in the cache.
+        # this function is to return PC1/PC2 coordinates and proportions explained per axis, reusing cached PCoA results if possible.
+
+        method = self.pcoa_method
+        if method == 'landmark':
+            method = 'landmark{}_seed{}_positive'.format(self.landmarks, self.seed)
+        elif method == 'fsvd':
+            method = 'fsvd_seed{}'.format(self.seed)
+        cached = None
+        if self._cache_key and (data_matrix is None or tuple(data_matrix.ids) == tuple(self._valid_samples or ())):
+            cached = self.cache.load_pcoa(self._cache_key, method = method)
+        if cached is None:
+            if self.pcoa_method == 'eigh':
+                from skbio.stats.ordination import pcoa
+
+                PCoAs = pcoa(data_matrix)
+                ids = data_matrix.ids
+                axes_coordinates = PCoAs.samples.iloc[:, :axes].to_numpy()
+                eigvals = PCoAs.eigvals.to_numpy()
+                proportion_explained = PCoAs.proportion_explained.to_numpy()
+            elif self.pcoa_method == 'fsvd':
+                from fast_pcoa import fsvd_pcoa
+
+                ids = data_matrix.ids
+                axes_coordinates, eigvals, proportion_explained = fsvd_pcoa(data_matrix.data, dimensions = axes, seed = self.seed)
+            else:
+                from fast_pcoa import landmark_pcoa
+
+                trans_func, diversity_metric, amplifier = self.distance_params
+                ids, matrix = self.build_abundance_matrix(trans_func, amplifier)
+                axes_coordinates, eigvals, proportion_explained = landmark_pcoa(matrix, diversity_metric, landmarks = self.landmarks,
+                                                                               dimensions = axes, seed = self.seed)
+            if self._cache_key:
+                self.cache.save_pcoa(self._cache_key, ids, axes_coordinates, eigvals, proportion_explained, method = method)
+        else:
+            ids, axes_coordinates, eigvals, proportion_explained = cached
+        self._valid_samples = tuple(ids)
+        samples = pd.DataFrame(np.asarray(axes_coordinates), index = list(ids),
+                               columns = ['PC{}'.format(i + 1) for i in range(axes_coordinates.shape[1])])
+        PC_explained = pd.Series(np.asarray(proportion_explained), index = ['PC{}'.format(i + 1) for i in range(len(proportion_explained))])
+
+        return samples.loc[:, ["PC1", "PC2"]], PC_explained # Take first two coordinates
+
+    def permanova_test(self, data_matrix, index_col, variable, permutations = 999, seed = 0):
         # data_matrix: the skbio style matrix fed into PCoA analysis.
-        # this function is to perform permanova test.
-        # Note: this test is a bit inconsistent with R package, be careful.
+        # this function is to perform permanova test on a single variable.
 
         permanova_results = namedtuple('permanova_results', ['statistic', 'pvalue'])
 
-        metadata_df = self.get_valid_metadata(index_col, [variable])
+        stats_df = self.permutation_tests(data_matrix, index_col, [variable], methods = ['permanova'],
+                                          permutations = permutations, seed = seed)
+
+        return permanova_results(stats_df.loc[0, 'statistic'], stats_df.loc[0, 'p-value'])
+
+    def permutation_tests(self, data_matrix, index_col, variables, methods = ['permanova', 'anosim'],
+                          permutations = 999, nproc = 1, seed = 0):
+        # data_matrix: the skbio style matrix fed into PCoA analysis.
+        # index_col: the column name for index column.
+        # variables: a list of metadata columns to test.
+        # methods: a list of test methods, <permanova> and/or <anosim>.
+        # this function is to run permutation tests for all variables sharing one distance matrix, see permutation_tests.py.
+        # Variables with a single group or only singleton groups are kept in the output with NA statistics and p-values.
 
-        anosim_test = anosim(data_matrix, metadata_df, column= variable, permutations = 999)
+        from permutation_tests import run_permutation_tests
 
+        metadata_df = self.get_valid_metadata(index_col, variables)
 
-        return permanova_results(anosim_test['test statistic'], anosim_test["p-value"])
+        return run_permutation_tests(data_matrix, metadata_df, variables, methods = methods,
+                                     permutations = permutations, nproc = nproc, seed = seed, skip_degenerate = True)
 
     def pcoa_plotting(self, data_matrix, opt_figure, index_col, df_opt, 
                       variable1 = None, variable2 = None, variable3 = None, 
@@ -245,6 +547,10 @@ class BetaDiversity:
                       font_style = "sans-serif,Arial", font_size = 11):
         # this function is to plot the PCoA analysis results
         # palette: a mapping file in which 1st column is group name and 2nd column is color code. No header row!
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         font_family, font_type = font_style.split(",")
         fig, ax = plt.subplots()
         matplotlib.rcParams['font.family'] = font_family 
@@ -286,15 +592,43 @@ class BetaDiversity:
 
 if __name__ == '__main__':
     pars = read_args(sys.argv)
-    if pars['metadata']:
+    if not pars['abundance_table'] or not os.path.exists(pars['abundance_table']):
+        sys.exit('Please input an existing abundance table or store!')
+    if pars['test']:
+        from permutation_tests import SUPPORTED_METHODS
+        unknown_methods = [i for i in pars['test_methods'].split(',') if i not in SUPPORTED_METHODS]
+        if unknown_methods:
+            sys.exit("Please choose --test_methods from <permanova>/<anosim>, unknown: {}".format(",".join(unknown_methods)))
+    if pars['metadata'] and os.path.exists(pars['metadata']):
         if pars['sample_column']:
             variables = list(set([pars['variable1'], pars['variable2'], pars['variable3']]))
             variables = [i for i in variables if i]
             if len(variables) > 0:
-                b_diversity_analysis = BetaDiversity(pars['abundance_table'], pars['metadata'])
-                b_diversity_matrix = b_diversity_analysis.est_beta_diversity_matrix(pars['transformation'],
-                                                                                    pars['metric'],
-                                                                                    pars['amplifier'])
+                if pars['cache_dir']:
+                    from distance_cache import DistanceCache
+                    cache = DistanceCache(pars['cache_dir'], max_size_mb = pars['cache_max_size'])
+                else:
+                    cache = None
+                if pars['pcoa_method'] == 'fsvd':
+                    print("Warning: with --pcoa_method fsvd, PC1(%)/PC2(%) are relative to the trace of the centered matrix, \
+which includes negative eigenvalues, and can be larger than with --pcoa_method eigh.")
+                b_diversity_analysis = BetaDiversity(pars['abundance_table'], pars['metadata'], cache = cache,
+                                                     pcoa_method = pars['pcoa_method'],
+                                                     landmarks = pars['landmarks'],
+                                                     seed = pars['seed'],
+                                                     nproc = pars['nproc'],
+                                                     distance_engine = pars['distance_engine'],
+                                                     dtype = pars['dtype'],
+                                                     matrix_format = pars['matrix_format'],
+                                                     clade_level = pars['clade_level'],
+                                                     feature_filter = {i: pars[i] for i in FILTER_PARAMS if pars[i] is not None})
+                if pars['pcoa_method'] == 'landmark' and not pars['test']:
+                    b_diversity_analysis.define_distance(pars['transformation'], pars['metric'], pars['amplifier'])
+                    b_diversity_matrix = None # landmark PCoA does not need the full distance matrix
+                else:
+                    b_diversity_matrix = b_diversity_analysis.est_beta_diversity_matrix(pars['transformation'],
+                                                                                        pars['metric'],
+                                                                                        pars['amplifier'])
                 b_diversity_analysis.pcoa_plotting(b_diversity_matrix,
                                                    pars['output_figure'],
                                                    pars['sample_column'],
@@ -309,15 +643,20 @@ if __name__ == '__main__':
                                                    font_size = pars['font_size']
                                                    )
                 if pars['test']:
-                    results_matrix = []
-                    for single_variable in variables:
-                        permanova_opt = b_diversity_analysis.permanova_test(b_diversity_matrix,
-                                                                             pars['sample_column'],
-                                                                             single_variable)
-                        
-                        results_matrix.append([single_variable, permanova_opt.statistic, permanova_opt.pvalue])
-                    stats_df = pd.DataFrame(results_matrix, columns = ['factor', 'statistic', 'p-value'])
-                    stats_df.to_csv(pars['test'], sep = '\t', index = False)       
+                    if pars['test_variables']:
+                        test_variables = pars['test_variables'].split(',')
+                    else:
+                        test_variables = [i for i in dict.fromkeys([pars['variable1'], pars['variable2'], pars['variable3']]) if i]
+                    stats_df = b_diversity_analysis.permutation_tests(b_diversity_matrix,
+                                                                      pars['sample_column'],
+                                                                      test_variables,
+                                                                      methods = pars['test_methods'].split(','),
+                                                                      permutations = pars['permutations'],
+                                                                      nproc = pars['nproc'],
+                                                                      seed = pars['seed'])
+                    stats_df.to_csv(pars['test'], sep = '\t', index = False, na_rep = 'NA')
+                    for variable in stats_df.loc[stats_df['statistic'].isna(), 'factor'].unique():
+                        print("Variable {} is skipped, it needs at least two groups and one group with more than one sample".format(variable))
             else:
                 sys.exit("None of three variables were detected. Please specify at least one variable using --variable1, --variable2 or --variable3!")
         else:
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+NAME: permutation_tests.py
+DESCRIPTION: permutation_tests.py is a python module to run PERMANOVA and ANOSIM tests on a beta diversity distance matrix
+             for many metadata variables. The distance matrix and its derived forms (squared distances, ranks) are prepared
+             only once and shared by all tests, permutations are generated in vectorized blocks and blocks can be spread
+             across a process pool. Every block has its own seed derived from the user seed, so results do not depend on
+             the number of processors. The block seeding helpers are shared with mosaic_plot.py and
+             cumulative_distribution_function.py.
+DATE: 12.03.2024
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+import pandas as pd
+import numpy as np
+
+SUPPORTED_METHODS = ['permanova', 'anosim']
+
+_shared_tester = None # the tester object living in each worker process of the pool.
+
+def random_stream_key(*names):
+    # names: the names identifying one test, e.g. a variable or a pair of groups.
+    # this function is to derive the key of the random stream of a test from its names only, so p-values do not depend
+    # on the position of the test in a batch.
+    return zlib.crc32("\t".join(names).encode())
+
+def permutation_blocks(permutations, block_size):
+    # this function is to yield (block index, number of permutations) of every block, the last block may be smaller.
+    for block_index, start in enumerate(range(0, permutations, block_size)):
+        yield block_index, min(block_size, permutations - start)
+
+def permuted_labels(codes, permutations, seed, stream_key, block_index):
+    # codes: the labels to permute.
+    # permutations: the number of permutations in this block.
+    # seed, stream_key, block_index: together they define the random stream of this block.
+    # this function is to return a permutations x len(codes) array, one permutation of codes per row. Every block has its
+    # own seed derived from the user seed, so results are the same whether blocks run in one process or in a pool.
+
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (stream_key, block_index)))
+
+    return rng.permuted(np.tile(codes, (permutations, 1)), axis = 1)
+
+class PermutationTester:
+
+    """
+    This object is to run permutation-based tests (PERMANOVA and ANOSIM) against one shared distance matrix.
+    """
+
+    def __init__(self, ids, condensed, block_elements = 2 ** 23):
+        # ids: a list of sample names in the order of the distance matrix.
+        # condensed: the condensed (upper triangle, row-major) form of the distance matrix.
+        # block_elements: the approximate number of (permutation x pair) cells handled at once, bounding memory per block.
+
+        self.ids = list(ids)
+        self.condensed = np.asarray(condensed, dtype = np.float64)
+        self.block_elements = block_elements
+        self._forms = {} # cache of derived forms of the distance matrix, keyed by the mask of kept samples.
+
+    def derived_forms(self, keep = None):
+        # keep: a boolean array marking samples used by a test, None means all samples.
+        # this function is to return the pair indices, squared distances and ranks of the distance matrix restricted to kept samples.
+        # Forms are computed once per sample subset and reused by every test and permutation block on that subset.
+
+        n = len(self.ids)
+        if keep is None:
+            keep = np.ones(n, dtype = bool)
+        key = np.packbits(keep).tobytes()
+        if key not in self._forms:
+            rows, cols = np.triu_indices(n, k = 1)
+            if keep.all():
+                distances = self.condensed
+            else:
+                pair_mask = keep[rows] & keep[cols]
+                new_index = np.cumsum(keep) - 1 # position of each kept sample in the subset
+                rows, cols = new_index[rows[pair_mask]], new_index[cols[pair_mask]]
+                distances = self.condensed[pair_mask]
+            from scipy.stats import rankdata
+
+            self._forms[key] = (rows.astype(np.int32), cols.astype(np.int32), distances ** 2, rankdata(distances))
+
+        return self._forms[key]
+
+    def statistics(self, groupings, keep, methods):
+        # groupings: a 2D array of integer group codes, one row per (permuted) grouping of the kept samples.
+        # keep: a boolean array marking samples used by the test.
+        # methods: a list of test methods, <permanova> and/or <anosim>.
+        # this function is to compute test statistics for all groupings in one vectorized pass over the distance pairs.
+
+        rows, cols, squared, ranks = self.derived_forms(keep)
+        n = groupings.shape[1]
+        group_sizes = np.bincount(groupings[0])
+        group_number = np.count_nonzero(group_sizes)
+        same_group = groupings[:, rows] == groupings[:, cols] # within-group pair indicators, one row per grouping
+        opt = {}
+        if 'permanova' in methods:
+            inv_sizes = np.zeros(len(group_sizes))
+            inv_sizes[group_sizes > 0] = 1 / group_sizes[group_sizes > 0]
+            s_T = squared.sum() / n
+            s_W = np.where(same_group, inv_sizes[groupings[:, rows]], 0.0) @ squared
+            opt['permanova'] = ((s_T - s_W) / (group_number - 1)) / (s_W / (n - group_number))
+        if 'anosim' in methods:
+            pair_number = len(ranks)
+            within_number = int((group_sizes * (group_sizes - 1) // 2).sum()) # unchanged by permuting the labels
+            within_rank_sums = same_group.astype(np.float64) @ ranks
+            r_W = within_rank_sums / within_number
+            r_B = (ranks.sum() - within_rank_sums) / (pair_number - within_number)
+            opt['anosim'] = (r_B - r_W) / (pair_number / 2)
+
+        return opt
+
+    def permutation_block(self, codes, keep, methods, permutations, seed, stream_key, block_index):
+        # codes: integer group codes of kept samples.
+        # permutations: the number of permutations in this block.
+        # seed, stream_key, block_index: together they define the random stream of this block.
+        # this function is to compute permuted statistics for one block of label permutations.
+
+        return self.statistics(permuted_labels(codes, permutations, seed, stream_key, block_index), keep, methods)
+
+    def block_size(self, keep):
+        # this function is to decide how many permutations are handled in one block to keep memory bounded.
+        pair_number = len(self.derived_forms(keep)[0])
+
+        return max(1, min(1000, self.block_elements // max(pair_number, 1)))
+
+def _init_worker(ids, condensed, block_elements):
+    # this function is to rebuild the shared tester once in each worker process.
+    global _shared_tester
+    _shared_tester = PermutationTester(ids, condensed, block_elements)
+
+def _run_block(args):
+    # this function is to run one permutation block inside a worker process.
+    return _shared_tester.permutation_block(*args)
+
+def group_codes(ids, grouping):
+    # ids: a list of sample names in the order of the distance matrix.
+    # grouping: a pandas series mapping sample names to group labels.
+    # this function is to convert group labels into integer codes, dropping samples without a label.
+
+    labels = grouping.reindex(ids)
+    keep = labels.notna().to_numpy()
+    codes = pd.factorize(labels[keep])[0].astype(np.int32)
+
+    return keep, codes
+
+def run_permutation_tests(distance_matrix, metadata_df, variables, methods = ['permanova', 'anosim'],
+                          permutations = 999, nproc = 1, seed = 0, skip_degenerate = False):
+    # distance_matrix: skbio DistanceMatrix shared by all tests.
+    # metadata_df: metadata dataframe indexed by sample names.
+    # variables: a list of metadata columns to test.
+    # methods: a list of test methods, <permanova> and/or <anosim>.
+    # permutations: the number of label permutations per variable.
+    # nproc: the number of processes used for running permutation blocks.
+    # seed: the seed for generating permutations, the same seed gives the same p-values regardless of nproc.
+    # skip_degenerate: whether a variable with a single group or only singleton groups is reported with NA statistics
+    #                  and p-values instead of raising a ValueError.
+    # this function is to run all requested tests and return a dataframe with one row per variable and method.
+
+    unknown = [i for i in methods if i not in SUPPORTED_METHODS]
+    if unknown:
+        raise ValueError("Unsupported test method(s): {}. Please choose from <permanova>/<anosim>.".format(",".join(unknown)))
+
+    tester = PermutationTester(distance_matrix.ids, distance_matrix.condensed_form())
+    tasks = []
+    observed = []
+    skipped = []
+    for variable in variables:
+        stream_key = random_stream_key(variable)
+        keep, codes = group_codes(tester.ids, metadata_df[variable])
+        if codes.max(initial = -1) < 1 or len(set(codes)) == len(codes):
+            if skip_degenerate:
+                skipped += [[variable, method, np.nan, np.nan, permutations, int(keep.sum()), len(set(codes))] for method in methods]
+                continue
+            raise ValueError("Variable {} must have at least two groups and one group with more than one sample.".format(variable))
+        observed.append((variable, keep, codes, tester.statistics(codes[np.newaxis, :], keep, methods)))
+        for block_index, block_permutations in permutation_blocks(permutations, tester.block_size(keep)):
+            tasks.append((variable, (codes, keep, methods, block_permutations, seed, stream_key, block_index)))
+
+    if nproc > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers = nproc,
+                                 initializer = _init_worker,
+                                 initargs = (tester.ids, tester.condensed, tester.block_elements)) as pool:
+            block_opts = list(pool.map(_run_block, [i[1] for i in tasks]))
+    else:
+        block_opts = [tester.permutation_block(*i[1]) for i in tasks]
+
+    results_matrix = []
+    for variable, keep, codes, stats in observed:
+        variable_blocks = [block_opts[i] for i, task in enumerate(tasks) if task[0] == variable]
+        for method in methods:
+            statistic = stats[method][0]
+            if permutations > 0:
+                permuted = np.concatenate([i[method] for i in variable_blocks])
+                p_value = (np.count_nonzero(permuted >= statistic) + 1) / (permutations + 1)
+            else:
+                p_value = np.nan
+            results_matrix.append([variable, method, statistic, p_value, permutations, int(keep.sum()), len(set(codes))])
+    results_matrix += skipped
+
+    return pd.DataFrame(results_matrix, columns = ['factor', 'method', 'statistic', 'p-value', 'permutations', 'sample_size', 'number_of_groups'])
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+NAME: render_batch.py
+DESCRIPTION: render_batch.py is a python script to run many jobs of the plotting scripts in this repository from one
+             manifest. Heavy libraries (matplotlib, seaborn, scikit-learn, scikit-bio, statsmodels) are imported only once
+             by a warm interpreter whose forked workers inherit them, every job runs its script as if it were called from
+             the command line, figures are drawn with the non-interactive Agg backend and closed after each job.
+             Heavy libraries are loaded only once the arguments are parsed and the manifest is read.
+DATE: 20.04.2024
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import traceback
+import runpy
+import shlex
+import time
+import os
+import sys
+import argparse
+import textwrap
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SUPPORTED_SCRIPTS = ['mosaic_plot', 'step_curve_drawer', 'cumulative_distribution_function',
+                     'multi_variable_pcoa_plot', 'evaluation_kfold']
+
+WARM_MODULES = ['numpy', 'pandas', 'matplotlib.pyplot', 'scipy.stats', 'scipy.spatial.distance', 'seaborn',
+                'sklearn.ensemble', 'sklearn.metrics', 'sklearn.model_selection',
+                'skbio.stats.ordination', 'skbio.stats.distance', 'skbio.diversity',
+                'statsmodels.graphics.mosaicplot', 'statsmodels.stats.multitest']
+
+def read_args(args):
+    # This function is to parse arguments
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                    description = textwrap.dedent('''\
+                                     This program is to run jobs of plotting scripts listed in a manifest within one warm interpreter.
+                                     '''),
+                                    epilog = textwrap.dedent('''\
+                                    examples: render_batch.py --manifest <jobs.tsv> --nproc 4 --log <jobs_status.tsv>
+                                    '''))
+
+    parser.add_argument('--manifest',
+                        nargs = '?',
+                        help = 'Input a tab-delimited (.tsv) or YAML (.yaml/.yml) manifest of jobs. A TSV manifest has columns <script> and <arguments> \
+                                (the command line options of the script) and an optional column <job> naming the job. A YAML manifest is a list of jobs \
+                                with the same keys, where arguments can also be a mapping of option names to values.',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--nproc',
+                        nargs = '?',
+                        help = 'Specify the number of jobs running at the same time. default: [1]',
+                        type = int,
+                        default = 1)
+
+    parser.add_argument('--log',
+                        nargs = '?',
+                        help = 'Specify a tab-delimited output file recording status, message and run time of each job. default: [None]',
+                        type = str,
+                        default = None)
+
+    return vars(parser.parse_args())
+
+def script_path(script):
+    # script: a script name with or without .py, e.g. mosaic_plot.
+    # this function is to resolve a script of this repository to its path.
+
+    name = os.path.basename(script)
+    if name.endswith('.py'):
+        name = name[:-3]
+    if name not in SUPPORTED_SCRIPTS:
+        sys.exit("Please choose script from <{}>, {} is not supported".format(">/<".join(SUPPORTED_SCRIPTS), script))
+
+    return os.path.join(SCRIPT_DIR, name + '.py')
+
+def argument_list(arguments):
+    # arguments: a command line string, a list of tokens or a mapping of option names to values.
+    # this function is to turn the arguments of a job into argv tokens. In a mapping, True adds a bare flag,
+    # False or None leaves the option out, and option names get a leading -- if they lack one.
+
+    if arguments is None:
+        return []
+    if isinstance(arguments, str):
+        return shlex.split(arguments)
+    if isinstance(arguments, dict):
+        tokens = []
+        for option, value in arguments.items():
+            option = option if option.startswith('-') else '--' + option
+            if value is True:
+                tokens.append(option)
+            elif value is not None and value is not False:
+                tokens += [option, str(value)]
+        return tokens
+
+    return [str(i) for i in arguments]
+
+def read_manifest(manifest_file):
+    # manifest_file: a TSV or YAML manifest, see read_args.
+    # this function is to return a list of jobs (job name, script path, argv tokens).
+
+    import pandas as pd
+
+    if manifest_file.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            sys.exit("Please install PyYAML to read YAML manifests, or use a tab-delimited manifest")
+        entries = yaml.safe_load(open(manifest_file)) or []
+        if isinstance(entries, dict):
+            entries = entries.get('jobs', [])
+    else:
+        entries = pd.read_csv(manifest_file, sep = '\t', dtype = str, keep_default_na = False).to_dict('records')
+
+    jobs = []
+    for job_number, entry in enumerate(entries):
+        if 'script' not in entry:
+            sys.exit("Job {} of {} lacks a script".format(job_number, manifest_file))
+        job_name = entry.get('job') or "{}_{}".format(job_number, os.path.basename(entry['script']))
+        jobs.append((str(job_name), script_path(entry['script']), argument_list(entry.get('arguments'))))
+
+    return jobs
+
+def warm_up(modules = WARM_MODULES):
+    # this function is to set the Agg backend and import heavy modules once so that all jobs share them. Modules which
+    # are not installed are skipped, the job needing them will report the import error.
+
+    import matplotlib
+    matplotlib.use('Agg')
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+def run_job(job):
+    # job: (job name, script path, argv tokens).
+    # this function is to run one script as __main__ with the job's argv, and return (job name, script, status, message, seconds).
+    # rcParams are reset before each job so that the style set by one job does not leak into the next one.
+
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    job_name, path, tokens = job
+    matplotlib.rcdefaults()
+    argv = sys.argv
+    sys.argv = [path] + tokens
+    start = time.time()
+    status, message = 'ok', ''
+    try:
+        runpy.run_path(path, run_name = '__main__')
+    except SystemExit as exit_info:
+        if exit_info.code not in [None, 0]:
+            status, message = 'failed', str(exit_info.code)
+    except Exception:
+        status, message = 'failed', traceback.format_exc().strip().split('\n')[-1]
+    finally:
+        sys.argv = argv
+        plt.close('all')
+
+    return job_name, os.path.basename(path), status, message, round(time.time() - start, 3)
+
+def run_jobs(jobs, nproc = 1):
+    # jobs: a list of jobs from read_manifest.
+    # nproc: the number of worker processes, each running one job at a time.
+    # this function is to run all jobs and return a dataframe of their status in manifest order.
+
+    import pandas as pd
+
+    warm_up()
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers = nproc) as pool:
+            status = list(pool.map(run_job, jobs))
+    else:
+        status = [run_job(job) for job in jobs]
+
+    return pd.DataFrame(status, columns = ['job', 'script', 'status', 'message', 'seconds'])
+
+
+if __name__ == "__main__":
+
+    pars = read_args(sys.argv)
+    if not pars['manifest']:
+        sys.exit("Please specify the manifest of jobs with --manifest!")
+    jobs = read_manifest(pars['manifest'])
+    status_df = run_jobs(jobs, pars['nproc'])
+    if pars['log']:
+        status_df.to_csv(pars['log'], sep = '\t', index = False)
+    failed = status_df[status_df['status'] != 'ok']
+    print("{} of {} jobs finished successfully".format(len(status_df) - len(failed), len(status_df)))
+    for _, row in failed.iterrows():
+        print("{} ({}) failed: {}".format(row['job'], row['script'], row['message']))
+    if len(failed):
+        sys.exit(1)
@@ -9,11 +9,17 @@ AUTHOR: Kun D. Huang
 """
 
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import numpy as np
 import sys
+import os
 import argparse
 import textwrap
+import math
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from mpa_reader import read_mpa_table
+
+# matplotlib is imported only when a figure is drawn.
 
 def read_args(args):
     # This function is to parse arguments
@@ -27,7 +33,8 @@ def read_args(args):
                                     '''))
     parser.add_argument('--abundance_table',
                         nargs = '?',
-                        help = 'Input the MetaPhlAn4 abundance table which contains only a group of species one wants to analyze their co-presense state, with metadata being wedged.',
+                        help = 'Input the MetaPhlAn4 abundance table which contains only a group of species one wants to analyze their co-presense state, with metadata being wedged. \
+                        Plain, compressed (.bz2/.gz) or converted by convert_mpa_table.py.',
                         type = str,
                         default = None)
 
@@ -38,6 +45,13 @@ def read_args(args):
                         type = str,
                         default = None)
 
+    parser.add_argument('--md_rows',
+                        nargs = '?',
+                        help = 'Input row numbers of wedged metadata, zero-based without considering header row, comma delimited. By default, \
+                        rows with non-numeric values and the row of --variable are taken as metadata, so a numeric-coded variable (e.g. 0/1) works too.',
+                        type = str,
+                        default = None)
+
     parser.add_argument('--minimum_abundance',
                         nargs = '?',
                         help = 'Specify the minimum abundance used for determining presense. note: [0, 100] and [0.0] by default',
@@ -46,7 +60,7 @@ def read_args(args):
 
     parser.add_argument('--species_number',
                         nargs = '?',
-                        help = 'Specify the total number of multiple species in the analysis.',
+                        help = 'Specify the total number of multiple species in the analysis, required.',
                         type = int)
 
 
@@ -61,6 +75,44 @@ def read_args(args):
                         type = str,
                         default = None)
 
+    parser.add_argument('--thresholds',
+                        nargs = '?',
+                        help = 'Specify presence thresholds to sweep, comma delimited, e.g. 0,0.01,0.1,1. One panel is drawn per threshold \
+                        and --minimum_abundance is ignored. default: [None]',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--bootstrap',
+                        nargs = '?',
+                        help = 'Specify the number of bootstrap resamplings of samples within each category for drawing confidence bands \
+                        in the sweep mode. [0] by default, no bands.',
+                        type = int,
+                        default = 0)
+
+    parser.add_argument('--confidence',
+                        nargs = '?',
+                        help = 'Specify the confidence level of bootstrap bands. [0.95] by default.',
+                        type = float,
+                        default = 0.95)
+
+    parser.add_argument('--output_table',
+                        nargs = '?',
+                        help = 'Specify the output file name for storing co-presence percentages in long format (sweep mode).',
+                        type = str,
+                        default = None)
+
+    parser.add_argument('--nproc',
+                        nargs = '?',
+                        help = 'Specify the number of processors for running bootstrap resamplings. [1] by default.',
+                        type = int,
+                        default = 1)
+
+    parser.add_argument('--seed',
+                        nargs = '?',
+                        help = 'Specify the random seed of bootstrap resamplings, the same seed gives the same bands with any --nproc. [0] by default.',
+                        type = int,
+                        default = 0)
+
     return vars(parser.parse_args())
 
 class PandasDealer:
@@ -72,65 +124,142 @@ class PandasDealer:
 
         self.df_ = df_
 
-    def read_csv(self):
-        # Ths fucntion will read tab-delimitted file into a pandas dataframe.
+    def read_csv(self, md_rows = None, md_names = None):
+        # md_rows: row numbers of metadata rows, None for rows with non-numeric values.
+        # md_names: names of rows always taken as metadata, even if their values are numbers.
+        # Ths fucntion will stream the tab-delimitted file (plain, .bz2 or .gz), splitting metadata rows from abundance rows.
 
-        return pd.read_csv(self.df_, sep = '\t', index_col = False, low_memory=False)
+        return read_mpa_table(self.df_, md_rows = md_rows, md_names = md_names, dtype = np.float64, detect_metadata = md_rows is None)
 
     def rotate_df(self):
         # this function is to rotate the metaphlan-style table into tidy dataframe to ease searching work,
+        # one row per sample with metadata columns as text followed by abundance columns as numbers.
 
-        df_ = self.read_csv()
-        df_rows_lists = df_.values.tolist()
-        rotated_df_dict = {df_.columns[0]: df_.columns[1:]}
-        for i in df_rows_lists:
-            rotated_df_dict[i[0]] = i[1:]
-
-        rotated_df = pd.DataFrame.from_dict(rotated_df_dict)
+        table = self.read_csv()
+        rotated_df = table.metadata.reset_index()
+        abundance_df = pd.DataFrame(table.matrix, columns = table.features)
+        rotated_df = pd.concat([rotated_df, abundance_df], axis = 1)
         
         return rotated_df
 
 class CopEstimator:
 
-    def __init__(self, sub_df_md):
+    def __init__(self, sub_df_md, md_rows = None):
         self.sub_df_md = sub_df_md # sub_df_md: a subset of dataframe which contains only a group of species one wants to do co-presence analysis.
+        self.md_rows = md_rows # md_rows: row numbers of metadata rows, None for rows with non-numeric values.
 
-    def make_copresense_df(self, factor, total_species_nr, threshold = 0.0):
-        # factor: the factor you want to assess the category percentage.
-        # total_species_nr: specify the total number of species you want to do co-presense analysis.
-
+    def load_species_matrix(self, factor, total_species_nr):
+        # this function is to return category labels of the factor and the samples x species matrix of the last total_species_nr species.
+        # The row of the factor is always read as metadata, so a numeric-coded factor is never counted as a species.
 
-        rotated_df = PandasDealer(self.sub_df_md)
-        rotated_df = rotated_df.rotate_df()
-        cols = rotated_df.columns[-total_species_nr: ].to_list() 
-        categories = list(set(rotated_df[factor].to_list()))
-        
+        table = PandasDealer(self.sub_df_md).read_csv(self.md_rows, [factor])
+        if factor not in table.metadata.columns:
+            sys.exit("Variable {} is not found among metadata rows of {}".format(factor, self.sub_df_md))
+        matrix = np.asarray(table.matrix[:, -total_species_nr: ], dtype = np.float64)
 
-        copresense = []
-        cate_name = []
-        ratios = []
-        for c in categories:
-            sub_df = rotated_df[rotated_df[factor] == c]
-            species_group_df = sub_df[cols]
-            species_group_df = species_group_df.apply(pd.to_numeric)
-            species_group_df['total'] = species_group_df[cols].gt(threshold).sum(axis=1)
-            for i in range(1, total_species_nr + 1):
-                ratio = count_non_zero_rows(species_group_df, i)
-                copresense.append(i)
-                cate_name.append(c)
-                ratios.append(ratio)
-
-        return pd.DataFrame.from_dict({"copresense": copresense,
-                                        factor: cate_name,
-                                        "percentage": ratios})
-
-def count_non_zero_rows(df_, nr):
-    total_rows = len(df_.index)
-    
-    sub_df = df_[df_['total'] >= nr]
-    ratio = len(sub_df.index)/total_rows
+        return table.metadata[factor].to_numpy(), matrix
 
-    return ratio
+    def make_copresense_df(self, factor, total_species_nr, threshold = 0.0):
+        # factor: the factor you want to assess the category percentage.
+        # total_species_nr: specify the total number of species you want to do co-presense analysis.
+        # this function is to compute co-presence curves of all categories in one pass over the abundance matrix.
+
+        labels, matrix = self.load_species_matrix(factor, total_species_nr)
+        codes, categories = pd.factorize(labels)
+        ratios = copresence_ratios(presence_counts(matrix, threshold), codes, len(categories), total_species_nr)
+
+        return pd.DataFrame.from_dict({"copresense": np.tile(np.arange(1, total_species_nr + 1), len(categories)),
+                                        factor: np.repeat(np.asarray(categories), total_species_nr),
+                                        "percentage": ratios.ravel()})
+
+    def make_sweep_df(self, factor, total_species_nr, thresholds, bootstrap = 0, confidence = 0.95, nproc = 1, seed = 0,
+                      block_elements = 2 ** 22):
+        # thresholds: a list of presence thresholds evaluated in one pass.
+        # bootstrap: the number of resamplings of samples within each category, 0 for no confidence bands.
+        # confidence: the confidence level of the bands, taken from percentiles of bootstrap ratios.
+        # nproc: the number of processes running bootstrap blocks.
+        # seed: the seed of bootstrap resamplings.
+        # block_elements: the approximate number of (resampling x sample x threshold) cells handled at once.
+        # this function is to compute co-presence curves at many thresholds, returning a long-form dataframe
+        # with columns threshold, factor, copresense, percentage (and lower, upper with bootstrap).
+
+        labels, matrix = self.load_species_matrix(factor, total_species_nr)
+        thresholds = np.sort(np.asarray(thresholds, dtype = np.float64))
+        codes, categories = pd.factorize(labels)
+        counts = presence_count_sweep(matrix, thresholds)
+        threshold_codes = codes[:, np.newaxis] * len(thresholds) + np.arange(len(thresholds))
+        ratios = copresence_ratios(counts, threshold_codes, len(categories) * len(thresholds), total_species_nr)
+
+        opt_df = pd.DataFrame.from_dict({"threshold": np.tile(np.repeat(thresholds, total_species_nr), len(categories)),
+                                         factor: np.repeat(np.asarray(categories), len(thresholds) * total_species_nr),
+                                         "copresense": np.tile(np.arange(1, total_species_nr + 1), len(categories) * len(thresholds)),
+                                         "percentage": ratios.ravel()})
+        if bootstrap > 0:
+            tasks = []
+            for k, c in enumerate(categories):
+                category_counts = counts[codes == k]
+                stream_key = zlib.crc32(str(c).encode()) # the random stream depends on the category name, not on its position
+                block_size = max(1, min(1000, block_elements // max(category_counts.size, 1)))
+                for block_index, start in enumerate(range(0, bootstrap, block_size)):
+                    tasks.append((k, (category_counts, total_species_nr, min(block_size, bootstrap - start), seed, stream_key, block_index)))
+            if nproc > 1 and len(tasks) > 1:
+                with ProcessPoolExecutor(max_workers = nproc) as pool:
+                    block_opts = list(pool.map(bootstrap_block, [i[1] for i in tasks]))
+            else:
+                block_opts = [bootstrap_block(i[1]) for i in tasks]
+            lower, upper = [], []
+            for k in range(len(categories)):
+                resampled = np.concatenate([block_opts[i] for i, task in enumerate(tasks) if task[0] == k])
+                lower.append(np.quantile(resampled, (1 - confidence) / 2, axis = 0))
+                upper.append(np.quantile(resampled, (1 + confidence) / 2, axis = 0))
+            opt_df["lower"] = np.stack(lower).ravel()
+            opt_df["upper"] = np.stack(upper).ravel()
+
+        return opt_df
+
+def presence_counts(matrix, threshold = 0.0):
+    # matrix: the samples x species abundance matrix.
+    # this function is to count, for each sample, the species present above the threshold.
+    return np.count_nonzero(matrix > threshold, axis = 1)
+
+def copresence_ratios(counts, codes, category_nr, total_species_nr):
+    # counts: the number of present species in each sample.
+    # codes: the category code of each sample, an array of the same shape as counts.
+    # this function is to return a categories x species array, where [c, i - 1] is the fraction of samples in category c
+    # with at least i species present, from one bincount of (category, count) pairs and a reverse cumulative sum.
+
+    histogram = np.bincount((codes * (total_species_nr + 1) + counts).ravel(),
+                            minlength = category_nr * (total_species_nr + 1)).reshape(category_nr, total_species_nr + 1)
+    at_least = histogram[:, ::-1].cumsum(axis = 1)[:, ::-1] # samples with at least i species present
+
+    return at_least[:, 1:] / at_least[:, [0]]
+
+def presence_count_sweep(matrix, thresholds):
+    # matrix: the samples x species abundance matrix.
+    # thresholds: an array of presence thresholds.
+    # this function is to count present species of each sample at every threshold (samples x thresholds),
+    # sorting the values of each sample once and locating all thresholds in it with a binary search.
+
+    sorted_matrix = np.sort(matrix, axis = 1)
+    counts = np.empty((matrix.shape[0], len(thresholds)), dtype = np.int64)
+    for i, values in enumerate(sorted_matrix):
+        counts[i] = matrix.shape[1] - np.searchsorted(values, thresholds, side = 'right')
+
+    return counts
+
+def bootstrap_block(args):
+    # args: (counts of one category (samples x thresholds), total species number, number of resamplings, seed, stream key, block index).
+    # this function is to compute co-presence ratios (resamplings x thresholds x species) of one block of bootstrap resamplings,
+    # each block drawing from its own random stream so that results do not depend on how blocks are spread over processes.
+
+    counts, total_species_nr, replicates, seed, stream_key, block_index = args
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (stream_key, block_index)))
+    sample_nr, threshold_nr = counts.shape
+    resampled = counts[rng.integers(0, sample_nr, size = (replicates, sample_nr))] # resamplings x samples x thresholds
+    codes = np.arange(replicates)[:, np.newaxis, np.newaxis] * threshold_nr + np.arange(threshold_nr)
+    ratios = copresence_ratios(resampled, np.broadcast_to(codes, resampled.shape), replicates * threshold_nr, total_species_nr)
+
+    return ratios.reshape(replicates, threshold_nr, total_species_nr)
     
 
 class VisualTools:
@@ -139,6 +268,8 @@ class VisualTools:
         self.factor = factor
 
     def step_curves(self, opt_name, palette = None):
+        import matplotlib.pyplot as plt
+
         categories = list(set(self.processed_df[self.factor].to_list()))
         if palette:
             palette_dict = {i.rstrip().split('\t')[0]: i.rstrip().split('\t')[1] for i in open(palette).readlines()}
@@ -156,11 +287,73 @@ class VisualTools:
         plt.legend(title = self.factor)
         plt.savefig(opt_name, bbox_inches = "tight")
 
+    def faceted_step_curves(self, opt_name, palette = None, ncols = 4):
+        # this function is to draw one panel of step curves per presence threshold from the long-form dataframe of
+        # CopEstimator.make_sweep_df, with bootstrap bands if they were computed.
+
+        import matplotlib.pyplot as plt
+
+        categories = list(dict.fromkeys(self.processed_df[self.factor].to_list()))
+        thresholds = list(dict.fromkeys(self.processed_df["threshold"].to_list()))
+        palette_dict = {}
+        if palette:
+            palette_dict = {i.rstrip().split('\t')[0]: i.rstrip().split('\t')[1] for i in open(palette).readlines()}
+        ncols = min(ncols, len(thresholds))
+        nrows = math.ceil(len(thresholds) / ncols)
+        fig, axes = plt.subplots(nrows, ncols, figsize = (4 * ncols, 3.5 * nrows), sharex = True, sharey = True, squeeze = False)
+        for ax, t in zip(axes.ravel(), thresholds):
+            threshold_df = self.processed_df[self.processed_df["threshold"] == t]
+            for c in categories:
+                sub_df = threshold_df[threshold_df[self.factor] == c]
+                line, = ax.step(sub_df["percentage"]*100, sub_df["copresense"], label = c, color = palette_dict.get(c))
+                if "lower" in sub_df.columns:
+                    ax.fill_betweenx(sub_df["copresense"], sub_df["lower"]*100, sub_df["upper"]*100,
+                                     step = "post", color = line.get_color(), alpha = 0.2, linewidth = 0)
+            ax.set_title("Abundance > {}".format(t))
+        for ax in axes.ravel()[len(thresholds):]:
+            ax.set_visible(False)
+        for i in range(ncols):
+            bottom_ax = axes[(len(thresholds) - 1 - i) // ncols, i] # the lowest visible panel of each column
+            bottom_ax.xaxis.set_tick_params(labelbottom = True)
+            bottom_ax.set_xlabel("Percentage")
+        for ax in axes[:, 0]:
+            ax.set_ylabel("Co-presense")
+        axes[0, 0].legend(title = self.factor)
+        fig.suptitle("Number of species in an individual if present")
+        fig.savefig(opt_name, bbox_inches = "tight")
+        plt.close(fig)
+
 
 if __name__ == "__main__":
 
     pars = read_args(sys.argv)
-    cop_obj = CopEstimator(pars['abundance_table'])
-    p_df = cop_obj.make_copresense_df(pars['variable'], pars['species_number'], pars['minimum_abundance'])
-    vis_obj = VisualTools(p_df, pars['variable'])
-    vis_obj.step_curves(pars['output'], palette = pars['palette'])
+    if not pars['abundance_table'] or not os.path.exists(pars['abundance_table']):
+        sys.exit("Please input an existing abundance table or store with --abundance_table!")
+    if not pars['variable'] or not pars['output']:
+        sys.exit("Please specify the variable with --variable and the output figure with --output!")
+    if pars['md_rows'] and not all(i.strip().isdigit() for i in pars['md_rows'].split(',')):
+        sys.exit("Please give --md_rows as comma delimited row numbers, e.g. <0,1,2>")
+    md_rows = [int(i) for i in pars['md_rows'].split(',')] if pars['md_rows'] else None
+    if pars['species_number'] is None or pars['species_number'] < 1:
+        sys.exit("Please specify the total number of species (at least 1) with --species_number!")
+    if pars['thresholds']:
+        try:
+            thresholds = [float(i) for i in pars['thresholds'].split(',')]
+        except ValueError:
+            sys.exit("Please give --thresholds as comma delimited numbers, e.g. <0,0.01,0.1,1>")
+        if pars['bootstrap'] < 0:
+            sys.exit("Please give a non-negative number of resamplings with --bootstrap!")
+        if pars['bootstrap'] and not 0 < pars['confidence'] < 1:
+            sys.exit("Please give --confidence between 0 and 1, e.g. <0.95>")
+    cop_obj = CopEstimator(pars['abundance_table'], md_rows)
+    if pars['thresholds']:
+        p_df = cop_obj.make_sweep_df(pars['variable'], pars['species_number'], thresholds, bootstrap = pars['bootstrap'],
+                                     confidence = pars['confidence'], nproc = pars['nproc'], seed = pars['seed'])
+        if pars['output_table']:
+            p_df.to_csv(pars['output_table'], sep = '\t', index = False)
+        vis_obj = VisualTools(p_df, pars['variable'])
+        vis_obj.faceted_step_curves(pars['output'], palette = pars['palette'])
+    else:
+        p_df = cop_obj.make_copresense_df(pars['variable'], pars['species_number'], pars['minimum_abundance'])
+        vis_obj = VisualTools(p_df, pars['variable'])
+        vis_obj.step_curves(pars['output'], palette = pars['palette'])